@@ -0,0 +1,554 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import asyncio
+import contextlib
+import functools
+import json
+import sys
+import time
+from collections import deque
+from http.cookies import SimpleCookie
+from typing import IO, AsyncIterator, Awaitable, Callable, List, Optional, Set, Tuple
+
+import aiohttp
+from yarl import URL
+
+from blobstore import IncompleteDownload
+from converter import Converter
+from parsing import parse_album_list_page, parse_article_page
+from scheduler import AsyncAdaptiveLimiter, TokenBucket
+from spider import (
+    Cancelled,
+    JSONType,
+    NotCached,
+    RenrenSpider,
+    T,
+    album_dirname,
+    article_name,
+    is_retryable,
+    largest_first,
+    photo_name,
+    render_article,
+    render_status_page,
+)
+from transport import DNS_TTL
+
+
+class AsyncRenrenSpider(RenrenSpider):
+    """Crawl engine running every request as a coroutine on one event loop.
+
+    Login still goes through the synchronous session, the cookies are handed
+    over to an aiohttp session when the dump starts.
+    """
+
+    DEFAULT_CONCURRENCY = 64
+    DEFAULT_PER_HOST_CONCURRENCY = 16
+    # Seconds an idle connection is kept, a photo host is often idle while
+    # the next album page is listed.
+    KEEPALIVE_TIMEOUT = 60
+
+    def __init__(self) -> None:
+        super().__init__()
+        self.per_host_concurrency = self.DEFAULT_PER_HOST_CONCURRENCY
+        self.session = None
+        self.bucket = None
+
+    def set_params(self, *, per_host_concurrency=None, **kwargs) -> None:
+        # The session is only used to log in, aiohttp speaks HTTP/1.1.
+        # Checked first, so a rejected call leaves the spider as it was.
+        if kwargs.get("transport") == "http2":
+            raise ValueError("The async engine doesn't support the http2 transport")
+        super().set_params(**kwargs)
+        if per_host_concurrency:
+            self.per_host_concurrency = max(1, int(per_host_concurrency))
+
+    def _make_cookie_jar(self) -> aiohttp.CookieJar:
+        jar = aiohttp.CookieJar(unsafe=True)
+        for cookie in self.s.cookies:
+            morsel = SimpleCookie()
+            morsel[cookie.name] = cookie.value
+            morsel[cookie.name]["path"] = cookie.path
+            if cookie.domain_specified:
+                morsel[cookie.name]["domain"] = cookie.domain
+            jar.update_cookies(morsel, URL(f"http://{cookie.domain.lstrip('.')}/"))
+        return jar
+
+    async def acheckpoint(self) -> None:
+        # Waiting on the threading event would block the whole loop.
+        while not self._running.is_set():
+            await asyncio.sleep(0.1)
+        if self._cancelled.is_set():
+            raise Cancelled()
+
+    async def on_achunk(self, nbytes: int) -> None:
+        if self.bucket is not None:
+            delay = self.bucket.reserve(nbytes)
+            if delay:
+                await asyncio.sleep(delay)
+        await self.acheckpoint()
+        self.bytes_transferred += nbytes
+
+    def convert(self, fn: Callable[..., T], *args) -> Awaitable[T]:
+        return asyncio.wrap_future(super().convert(fn, *args))
+
+    def blocking(self, fn: Callable[..., T], *args) -> Awaitable[T]:
+        """Run disk or SQLite work in a thread. On the loop it would stall
+        every transfer in flight, hashing a large photo takes a while.
+        """
+        return asyncio.get_running_loop().run_in_executor(None, functools.partial(fn, *args))
+
+    @contextlib.asynccontextmanager
+    async def open_in_thread(self, name: str, mode: str) -> AsyncIterator[IO]:
+        """``self.output.open`` entered and left in a thread, where an archive
+        writes the member. Writes to the file still need ``blocking``.
+        """
+        opened = self.output.open(name, mode)
+        f = await self.blocking(opened.__enter__)
+        try:
+            yield f
+        except BaseException:
+            if not await self.blocking(opened.__exit__, *sys.exc_info()):
+                raise
+        else:
+            await self.blocking(opened.__exit__, None, None, None)
+
+    async def aretrying(
+        self, fn: Callable[..., Awaitable[T]], *args,
+        progress: Optional[Callable[[], int]] = None,
+    ) -> T:
+        """Await ``fn(*args)`` with the retry and adaptive limiting rules of
+        RenrenSpider.retrying.
+        """
+        attempt = 0
+        while True:
+            await self.acheckpoint()
+            mark = await self.blocking(progress) if progress else 0
+            try:
+                async with self.limiter:
+                    result = await fn(*args)
+            except (aiohttp.ClientError, asyncio.TimeoutError, IncompleteDownload) as e:
+                response_error = isinstance(e, aiohttp.ClientResponseError)
+                status = e.status if response_error else None
+                if progress and await self.blocking(progress) > mark:
+                    attempt = 0
+                if attempt >= self.MAX_RETRY or not is_retryable(status):
+                    raise
+                self.limiter.on_failure()
+                self.metrics.inc("http_retries_total", reason=status or type(e).__name__)
+                retry_after = e.headers.get("Retry-After") if response_error and e.headers else None
+                await asyncio.sleep(self.retry_delay(attempt, retry_after))
+                attempt += 1
+            else:
+                self.limiter.on_success()
+                return result
+
+    async def _fetch_text(self, url: str) -> str:
+        started = time.perf_counter()
+        status, body = None, b""
+        try:
+            async with self.session.get(url) as resp:
+                status = resp.status
+                resp.raise_for_status()
+                body = await resp.read()
+                return body.decode(resp.get_encoding())
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            status = status or type(e).__name__
+            raise
+        finally:
+            self.metrics.record_request(
+                URL(url).host, status, time.perf_counter() - started, len(body)
+            )
+
+    async def fetch_text(self, url: str) -> str:
+        if self.offline:
+            return await self.blocking(super().fetch_text, url)
+        text = await self.aretrying(self._fetch_text, url)
+        if self.cache is not None:
+            await self.blocking(self.cache.put, url, text)
+        return text
+
+    async def fetch_json(self, url: str) -> JSONType:
+        return json.loads(await self.fetch_text(url))
+
+    async def fetch_album_list_page(self, offset: int) -> Tuple[List[JSONType], Optional[int]]:
+        url = self.ALBUM_LIST_URL.format(
+            user_id=self.user_id, offset=offset, limit=self.ALBUM_LIST_LIMIT
+        )
+        with self.metrics.timer("stage_seconds", stage="album_list"):
+            return parse_album_list_page(await self.fetch_text(url))
+
+    async def parse_album_list(self) -> List[JSONType]:
+        albums, total = await self.fetch_album_list_page(0)
+        if total is None:
+            page = albums
+            while len(page) == self.ALBUM_LIST_LIMIT:
+                page, _ = await self.fetch_album_list_page(len(albums))
+                albums.extend(page)
+        else:
+            pages = await asyncio.gather(*[
+                self.fetch_album_list_page(offset)
+                for offset in range(self.ALBUM_LIST_LIMIT, total, self.ALBUM_LIST_LIMIT)
+            ])
+            for page, _ in pages:
+                albums.extend(page)
+        return largest_first(albums)
+
+    async def download_image(self, url: str, name: str) -> int:
+        if await self.blocking(self.output.exists, name):
+            # The size recorded with the blob saves a stat per photo.
+            blob = await self.blocking(self.state.get_blob, url)
+            if blob:
+                return blob["size"]
+            return await self.blocking(self.output.size, name)
+        blob = await self.fetch_blob(url)
+        with self.metrics.timer("stage_seconds", stage="write"):
+            await self.blocking(self.output.link_blob, blob["digest"], name)
+        return blob["size"]
+
+    async def fetch_blob(self, url: str) -> JSONType:
+        task = self._downloads.get(url)
+        if task is None:
+            task = self._downloads[url] = asyncio.ensure_future(self._download_blob(url))
+            task.add_done_callback(lambda _: self._downloads.pop(url, None))
+        return await task
+
+    async def _download_blob(self, url: str) -> JSONType:
+        blob = await self.blocking(self.state.get_blob, url)
+        if blob is None or not await self.blocking(self.output.has_blob, blob["digest"]):
+            with self.metrics.timer("stage_seconds", stage="photo"):
+                blob = await self.aretrying(
+                    self._fetch_blob, url, progress=lambda: self.partial_download(url).size
+                )
+            await self.blocking(self.state.record_blob, url, blob["digest"], blob["size"])
+        return blob
+
+    async def _fetch_blob(self, url: str) -> JSONType:
+        partial = await self.blocking(self.partial_download, url)
+        if partial.complete():
+            return await self.blocking(self.import_partial, partial)
+        host = URL(url).host
+        started = time.perf_counter()
+        try:
+            resp = await self.session.get(url, headers=partial.resume_headers())
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            self.metrics.record_request(host, type(e).__name__, time.perf_counter() - started)
+            raise
+        # As with the sync engine, the time is measured up to the headers.
+        self.metrics.record_request(host, resp.status, time.perf_counter() - started)
+        async with resp:
+            resp.raise_for_status()
+            if not partial.size and (resp.content_length or 0) < self.RESUME_MIN_SIZE:
+                # Small enough to hold, it is written and hashed in one go
+                # off the loop.
+                chunks = []
+                async for chunk in resp.content.iter_chunked(self.CHUNK_SIZE):
+                    await self.on_achunk(len(chunk))
+                    chunks.append(chunk)
+                blob = await self.blocking(self.store_blob, chunks)
+                self.metrics.inc("http_response_bytes_total", blob["size"], host=host)
+                return blob
+            f = await self.blocking(partial.begin, resp.status, resp.headers)
+            if f is None:
+                raise IncompleteDownload(f"{url}: range doesn't continue the part file")
+            if resp.status == 206:
+                self.metrics.inc("downloads_resumed_total")
+            received = 0
+            try:
+                async for chunk in resp.content.iter_chunked(self.CHUNK_SIZE):
+                    await self.on_achunk(len(chunk))
+                    await self.blocking(f.write, chunk)
+                    received += len(chunk)
+            finally:
+                await self.blocking(f.close)
+        self.metrics.inc("http_response_bytes_total", received, host=host)
+        return await self.blocking(self.import_partial, partial)
+
+    def store_blob(self, chunks: List[bytes]) -> JSONType:
+        with self.output.blob_writer() as blob:
+            for chunk in chunks:
+                blob.write(chunk)
+        return {"digest": blob.digest, "size": blob.size}
+
+    async def fetch_album_page(self, album: JSONType, url: str) -> List[str]:
+        with self.metrics.timer("stage_seconds", stage="album_page"):
+            data = await self.fetch_json(url)
+        photo_list = [image["url"] for image in data["photoList"]]
+        await self.blocking(self.state.add_album_photos, album, photo_list)
+        return photo_list
+
+    async def download_album(self, album: JSONType) -> None:
+        if await self.blocking(self.album_saved, album):
+            return
+        album_name = album_dirname(album)
+        listed = not self.refresh and await self.blocking(self.state.album_listed, album)
+        fetched = await self.blocking(self.saved_photos, album)
+
+        t = self.ui.progressbar(
+            total=int(album["photoCount"]), desc=f"Dumping album {album_name}"
+        )
+        t.update(len(fetched))
+
+        async def download_one(url: str) -> None:
+            name = photo_name(album_name, url)
+            size = await self.download_image(url, name)
+            await self.blocking(self.state.record_photo, album, url, name, size)
+            t.update()
+
+        def start_downloads(photo_list: List[str]) -> List[asyncio.Task]:
+            return [
+                asyncio.ensure_future(download_one(url))
+                for url in photo_list if url not in fetched
+            ]
+
+        # Photos start downloading as soon as the page listing them arrives.
+        if listed:
+            downloads = start_downloads(await self.blocking(self.state.album_photos, album))
+        else:
+            downloads = []
+            for page in asyncio.as_completed([
+                self.fetch_album_page(album, url) for url in self.album_page_urls(album)
+            ]):
+                downloads.extend(start_downloads(await page))
+        await asyncio.gather(*downloads)
+        if not listed:
+            await self.blocking(self.state.mark_album_listed, album)
+        await self.blocking(self.state.mark_album_done, album)
+
+    async def dump_albums(self) -> None:
+        if self.offline:
+            return
+        albums = iter(await self.parse_album_list())
+
+        # As in the sync engine only a few albums are worked on at a time, so
+        # the largest ones really go first.
+        async def work() -> None:
+            for album in albums:
+                await self.download_album(album)
+
+        await asyncio.gather(*[work() for _ in range(self.ALBUMS_IN_FLIGHT)])
+
+    async def iter_article_pages(self) -> AsyncIterator[List[JSONType]]:
+        if await self.blocking(self.state.feed_done, "articles"):
+            yield await self.blocking(self.state.articles)
+            if self.incremental and not self.offline:
+                async for items in self.iter_new_article_pages():
+                    yield items
+            return
+        url = self.ARTICLE_LIST_URL.format(user_id=self.user_id)
+        while url:
+            with self.metrics.timer("stage_seconds", stage="article_list"):
+                items, url = parse_article_page(await self.fetch_text(url))
+            await self.blocking(self.state.add_articles, items)
+            yield items
+        await self.blocking(self.state.mark_feed_done, "articles")
+
+    async def iter_new_article_pages(self) -> AsyncIterator[List[JSONType]]:
+        known = {article["url"] for article in await self.blocking(self.state.articles)}
+        url = self.ARTICLE_LIST_URL.format(user_id=self.user_id)
+        while url:
+            with self.metrics.timer("stage_seconds", stage="article_list"):
+                items, url = parse_article_page(await self.fetch_text(url))
+            new = [item for item in items if item["url"] not in known]
+            await self.blocking(self.state.add_articles, new)
+            yield new
+            if len(new) < len(items):
+                break
+
+    async def parse_article_list(self) -> List[JSONType]:
+        return [item async for items in self.iter_article_pages() for item in items]
+
+    async def download_article(self, article: JSONType) -> None:
+        if not self.offline and await self.blocking(self.output.exists, article_name(article)):
+            return
+        try:
+            with self.metrics.timer("stage_seconds", stage="article"):
+                text = await self.fetch_text(article["url"].replace('flag=0', 'flag=1'))
+        except NotCached:
+            return
+        content = await self.convert(render_article, article, text)
+        await self.blocking(self.save_article, article, content)
+
+    async def dump_articles(self) -> None:
+        fetched = set() if self.offline else await self.blocking(self.saved_articles)
+        t = self.ui.progressbar(total=0, desc="Dumping articles")
+        pending = set()
+
+        def finish(tasks: Set[asyncio.Future]) -> None:
+            for task in tasks:
+                task.result()
+                t.update()
+
+        async for items in self.iter_article_pages():
+            t.total += len(items)
+            for article in items:
+                if article["url"] in fetched:
+                    t.update()
+                    continue
+                pending.add(asyncio.ensure_future(self.download_article(article)))
+                if len(pending) >= self.concurrency * 2:
+                    done, pending = await asyncio.wait(
+                        pending, return_when=asyncio.FIRST_COMPLETED
+                    )
+                    finish(done)
+        if pending:
+            finish((await asyncio.wait(pending))[0])
+
+    async def fetch_status_page(self, page: int) -> JSONType:
+        data = await self.blocking(self.state.get_status_page, page)
+        if data is None:
+            url = self.STATUS_URL.format(user_id=self.user_id, page=page)
+            with self.metrics.timer("stage_seconds", stage="status_page"):
+                text = await self.fetch_text(url)
+            await self.blocking(self.state.record_status_page, page, url, text)
+            data = json.loads(text)
+        return data
+
+    async def convert_status_page(self, page: int) -> Tuple[int, str]:
+        items = (await self.fetch_status_page(page))["doingArray"]
+        return len(items), await self.convert(render_status_page, items)
+
+    async def sync_status(self, newest: int) -> None:
+        progressbar = self.ui.progressbar(total=0, desc="Syncing status")
+        fresh = []
+        page = 0
+        while True:
+            url = self.STATUS_URL.format(user_id=self.user_id, page=page)
+            with self.metrics.timer("stage_seconds", stage="status_page"):
+                data = json.loads(await self.fetch_text(url))
+            items = data["doingArray"]
+            new = [item for item in items if int(item["id"]) > newest]
+            fresh.extend(new)
+            page += 1
+            if len(new) < len(items) or page * self.STATUS_PAGE_SIZE >= data["count"]:
+                break
+        progressbar.total = len(fresh)
+        if fresh:
+            text = await self.convert(render_status_page, fresh)
+            with self.metrics.timer("stage_seconds", stage="write"):
+                await self.blocking(self.output.prepend, "status.md", text)
+            await self.blocking(self.record_status_sync, fresh[0])
+        progressbar.update(len(fresh))
+
+    async def dump_status(self) -> None:
+        if (
+            not self.offline and await self.blocking(self.state.feed_done, "status")
+            and await self.blocking(self.output.exists, "status.md")
+        ):
+            # Archives can't replace a member, so a finished status.md is
+            # kept, or only gets new entries added.
+            if not self.incremental:
+                return
+            newest = await self.blocking(self.newest_status)
+            if newest is not None:
+                await self.sync_status(newest)
+                return
+            await self.blocking(self.state.reset_feed, "status")
+        try:
+            await self.write_status()
+        except NotCached:
+            return
+
+    async def write_status(self) -> None:
+        first = await self.fetch_status_page(0)
+        if self.offline and await self.blocking(self.status_outdated, first):
+            return
+        page_count = -(-first["count"] // self.STATUS_PAGE_SIZE)
+
+        progressbar = self.ui.progressbar(total=first["count"], desc="Dumping status")
+        window = deque()
+        try:
+            async with self.open_in_thread("status.md", "w") as f:
+                next_page = 0
+                while next_page < page_count or window:
+                    while next_page < page_count and len(window) < self.STATUS_WINDOW:
+                        window.append(asyncio.ensure_future(self.convert_status_page(next_page)))
+                        next_page += 1
+                    count, text = await window.popleft()
+                    with self.metrics.timer("stage_seconds", stage="write"):
+                        await self.blocking(f.write, text)
+                    progressbar.update(count)
+        finally:
+            for task in window:
+                task.cancel()
+        await self.blocking(self.state.mark_feed_done, "status")
+        if first["doingArray"]:
+            await self.blocking(
+                self.state.set_feed_newest, "status", str(first["doingArray"][0]["id"])
+            )
+
+    def _trace_config(self) -> aiohttp.TraceConfig:
+        """Record DNS lookups and new connections per host, as the sync
+        engine's transport does.
+        """
+        metrics = self.metrics
+        trace = aiohttp.TraceConfig()
+
+        async def request_start(session, ctx, params) -> None:
+            ctx.host = params.url.host
+
+        async def dns_start(session, ctx, params) -> None:
+            ctx.dns_started = time.perf_counter()
+
+        async def dns_end(session, ctx, params) -> None:
+            metrics.observe(
+                "dns_lookup_seconds", time.perf_counter() - ctx.dns_started, host=params.host
+            )
+
+        async def dns_hit(session, ctx, params) -> None:
+            metrics.inc("dns_cache_hits_total", host=params.host)
+
+        async def connect_start(session, ctx, params) -> None:
+            ctx.connect_started = time.perf_counter()
+
+        async def connect_end(session, ctx, params) -> None:
+            metrics.observe(
+                "http_connect_seconds", time.perf_counter() - ctx.connect_started, host=ctx.host
+            )
+            metrics.inc("http_connections_total", host=ctx.host)
+
+        trace.on_request_start.append(request_start)
+        trace.on_dns_resolvehost_start.append(dns_start)
+        trace.on_dns_resolvehost_end.append(dns_end)
+        trace.on_dns_cache_hit.append(dns_hit)
+        trace.on_connection_create_start.append(connect_start)
+        trace.on_connection_create_end.append(connect_end)
+        return trace
+
+    async def _main(self) -> None:
+        connector = aiohttp.TCPConnector(
+            limit=self.concurrency,
+            limit_per_host=self.per_host_concurrency,
+            ttl_dns_cache=DNS_TTL,
+            keepalive_timeout=self.KEEPALIVE_TIMEOUT,
+        )
+        self.limiter = AsyncAdaptiveLimiter(self.concurrency)
+        async with aiohttp.ClientSession(
+            connector=connector,
+            timeout=aiohttp.ClientTimeout(
+                sock_connect=self.CONNECT_TIMEOUT, sock_read=self.READ_TIMEOUT
+            ),
+            cookie_jar=self._make_cookie_jar(),
+            headers=self.s.headers,
+            trust_env=True,
+            trace_configs=[self._trace_config()],
+        ) as self.session:
+            await asyncio.gather(*[
+                getattr(self, f"dump_{category}")() for category in self.categories
+            ])
+        self.session = None
+
+    def main(self, ui) -> None:
+        self.ui = ui
+        self.bucket = TokenBucket(self.bandwidth) if self.bandwidth else None
+        self.bytes_transferred = 0
+        self._cancelled.clear()
+        self.start_metrics()
+        self.open_output()
+        try:
+            with Converter(self.convert_workers) as self.converter:
+                asyncio.run(self._main())
+        finally:
+            self.converter = None
+            self.limiter = None
+            self.close_output()
+            self.stop_metrics()
@@ -0,0 +1,245 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""End-to-end dump benchmark against the mock server.
+
+Each category is dumped in a fresh process, so that wall time and peak RSS
+are measured in isolation. Run from the repository root:
+
+    python benchmarks/bench_dump.py --albums 20 --photos 200
+    python benchmarks/bench_dump.py --json before.json
+    python benchmarks/bench_dump.py --baseline before.json
+    python benchmarks/bench_dump.py --transport http2 --baseline before.json
+
+With ``--baseline`` the exit status is 1 when any category got slower than
+the baseline by more than ``--tolerance``.
+"""
+import argparse
+import json
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+from typing import Dict, List
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, HERE)
+
+from mock_server import add_arguments  # noqa: E402
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+CATEGORIES = ("albums", "articles", "status")
+
+
+class ProgressBar:
+    def __init__(self, total: int, desc: str) -> None:
+        self.current = 0
+        self.total = total
+        self.desc = desc
+
+    def update(self, number: int = 1) -> None:
+        self.current += number
+
+
+class QuietUI:
+    def __init__(self) -> None:
+        self.bars = []
+
+    def progressbar(self, total: int, desc: str) -> ProgressBar:
+        bar = ProgressBar(total, desc)
+        self.bars.append(bar)
+        return bar
+
+
+def peak_rss() -> float:
+    """Peak resident set size of this process in MB."""
+    if resource is None:
+        return 0.0
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Kilobytes on Linux, bytes on macOS.
+    return rss / 1024 ** (2 if sys.platform == "darwin" else 1)
+
+
+def run_one(args: argparse.Namespace) -> None:
+    """Dump a single category, print the measurements as JSON."""
+    import spider
+
+    instance = spider.get_spider_class(args.engine)()
+    instance.s.cookies.set("id", "1", domain=".renren.com")
+    params = {"user_id": "1", "output_dir": args.output, "categories": [args.category]}
+    if args.concurrency:
+        params["concurrency"] = args.concurrency
+    if args.output_format:
+        params["output_format"] = args.output_format
+    if args.transport:
+        params["transport"] = args.transport
+    instance.set_params(**params)
+    ui = QuietUI()
+    started = time.perf_counter()
+    instance.main(ui)
+    wall = time.perf_counter() - started
+    connections = instance.metrics.report()["counters"].get("http_connections_total", [])
+    print(json.dumps({
+        "wall": wall,
+        "items": sum(bar.current for bar in ui.bars),
+        "rss": peak_rss(),
+        "connections": sum(c["value"] for c in connections),
+    }))
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def server_stats(port: int) -> Dict[str, int]:
+    opener = urllib.request.build_opener(urllib.request.ProxyHandler({}))
+    with opener.open(f"http://127.0.0.1:{port}/__stats") as resp:
+        return json.load(resp)
+
+
+def start_server(args: argparse.Namespace, port: int) -> subprocess.Popen:
+    command = [sys.executable, os.path.join(HERE, "mock_server.py"), "--port", str(port)]
+    for name in (
+        "albums", "photos", "photo_size", "shared", "articles", "article_size",
+        "statuses", "latency", "bandwidth", "error_rate", "drop_rate",
+    ):
+        value = getattr(args, name)
+        if value is not None:
+            command += [f"--{name.replace('_', '-')}", str(value)]
+    if args.shared_urls:
+        command.append("--shared-urls")
+    server = subprocess.Popen(command, stdout=subprocess.DEVNULL)
+    deadline = time.monotonic() + 10
+    while True:
+        try:
+            server_stats(port)
+            return server
+        except OSError:
+            if time.monotonic() > deadline:
+                server.kill()
+                raise RuntimeError("Mock server didn't start")
+            time.sleep(0.05)
+
+
+def run_category(args: argparse.Namespace, port: int, category: str) -> Dict[str, float]:
+    output = tempfile.mkdtemp(prefix="renren-bench-")
+    # Archive dumps keep their state outside the output, in the temporary
+    # directory here so it is removed with it.
+    env = dict(
+        os.environ, HTTP_PROXY=f"http://127.0.0.1:{port}", NO_PROXY="",
+        XDG_STATE_HOME=os.path.join(output, ".state"), LOCALAPPDATA="",
+    )
+    command = [
+        sys.executable, os.path.abspath(__file__), "--run-one",
+        "--category", category, "--engine", args.engine, "--output", output,
+    ]
+    if args.concurrency:
+        command += ["--concurrency", str(args.concurrency)]
+    if args.output_format:
+        command += ["--output-format", args.output_format]
+    if args.transport:
+        command += ["--transport", args.transport]
+    try:
+        before = server_stats(port)
+        result = json.loads(subprocess.run(
+            command, env=env, cwd=output, check=True, stdout=subprocess.PIPE
+        ).stdout.decode().strip().splitlines()[-1])
+        after = server_stats(port)
+    finally:
+        shutil.rmtree(output, ignore_errors=True)
+    result["requests"] = after["requests"] - before["requests"]
+    result["mb"] = (after["bytes"] - before["bytes"]) / 1e6
+    result["items_per_second"] = result["items"] / result["wall"]
+    result["mb_per_second"] = result["mb"] / result["wall"]
+    return result
+
+
+def report(results: Dict[str, Dict[str, float]], baseline: Dict[str, Dict[str, float]]) -> None:
+    print(
+        f"{'category':<10}{'wall s':>8}{'items':>8}{'items/s':>10}"
+        f"{'MB':>8}{'MB/s':>8}{'reqs':>7}{'conns':>7}{'RSS MB':>8}"
+        + ("  vs baseline" if baseline else "")
+    )
+    for category, r in results.items():
+        line = (
+            f"{category:<10}{r['wall']:>8.2f}{r['items']:>8}{r['items_per_second']:>10.1f}"
+            f"{r['mb']:>8.1f}{r['mb_per_second']:>8.1f}{r['requests']:>7}"
+            f"{r.get('connections', 0):>7}{r['rss']:>8.1f}"
+        )
+        if category in baseline:
+            change = r["wall"] / baseline[category]["wall"] - 1
+            line += f"  {change:+.0%} wall"
+        print(line)
+
+
+def regressions(
+    results: Dict[str, Dict[str, float]], baseline: Dict[str, Dict[str, float]], tolerance: float
+) -> List[str]:
+    return [
+        category for category, r in results.items()
+        if category in baseline and r["wall"] > baseline[category]["wall"] * (1 + tolerance)
+    ]
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--engine", default="sync", help="Crawl engine to benchmark")
+    parser.add_argument("--concurrency", type=int, help="Spider concurrency")
+    parser.add_argument("--output-format", help="Spider output format")
+    parser.add_argument("--transport", help="HTTP transport of the sync engine")
+    parser.add_argument(
+        "--category", action="append", choices=CATEGORIES,
+        help="Category to run, may be repeated, defaults to all",
+    )
+    parser.add_argument("--json", help="Write the results to this file")
+    parser.add_argument("--baseline", help="Compare against results saved with --json")
+    parser.add_argument(
+        "--tolerance", type=float, default=0.1,
+        help="Allowed slowdown against the baseline, defaults to 0.1",
+    )
+    parser.add_argument("--run-one", action="store_true", help=argparse.SUPPRESS)
+    parser.add_argument("--output", help=argparse.SUPPRESS)
+    add_arguments(parser)
+    args = parser.parse_args()
+
+    if args.run_one:
+        args.category = args.category[0]
+        return run_one(args)
+
+    baseline = {}
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    port = free_port()
+    server = start_server(args, port)
+    try:
+        results = {
+            category: run_category(args, port, category)
+            for category in args.category or CATEGORIES
+        }
+    finally:
+        server.terminate()
+        server.wait()
+    report(results, baseline)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+    slower = regressions(results, baseline, args.tolerance)
+    if slower:
+        print(f"Slower than baseline: {', '.join(slower)}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,91 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Compare the parsing module against the regexes it replaced.
+
+Run from the repository root:
+
+    python benchmarks/bench_parsing.py [-n NUMBER]
+"""
+import argparse
+import json
+import os
+import re
+import sys
+import timeit
+
+import lxml.html
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+FIXTURES = os.path.join(ROOT, "benchmarks", "fixtures")
+sys.path.insert(0, ROOT)
+
+import parsing  # noqa: E402
+
+
+def regex_album_list(text):
+    albumlist = json.loads(re.findall(r"'albumList':\s*(\[[\s\S]*?\])", text)[0])
+    return [item for item in albumlist if item.get("photoCount")]
+
+
+def regex_article_body(text):
+    return re.findall(r'<div class="con">([\s\S]*?)</div>', text)[0].strip()
+
+
+def xpath_article_page(text):
+    tree = lxml.html.fromstring(text)
+    results = []
+    for element in tree.xpath('//div[@class="list"]/div[not(@class)]'):
+        results.append({
+            'title': element.xpath('a/text()')[0].strip(),
+            'url': element.xpath('a/@href')[0].strip(),
+            'createTime': element.xpath('p/text()')[0].strip()
+        })
+    next_url = tree.xpath('//a[@title="下一页"]/@href')
+    return results, next_url[0].strip() if next_url else None
+
+
+def article_complete(body):
+    return "第 59 段" in body and "评论" not in body
+
+
+CASES = [
+    # fixture, old, new, correctness check
+    ("album_list.html", regex_album_list, parsing.extract_album_list,
+     lambda albums: len(albums) == 40),
+    ("article.html", regex_article_body, parsing.extract_article_body, article_complete),
+    ("article_nested.html", regex_article_body, parsing.extract_article_body, article_complete),
+    ("article_list.html", xpath_article_page, parsing.parse_article_page,
+     lambda page: len(page[0]) == 10 and page[1] is not None),
+]
+
+
+def check(fn, text, expect):
+    try:
+        return "ok" if expect(fn(text)) else "wrong"
+    except Exception as e:
+        return f"error ({type(e).__name__})"
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-n", "--number", type=int, default=200, help="Runs per case")
+    args = parser.parse_args()
+
+    print(f"{'fixture':<22}{'impl':<6}{'pages/s':>10}{'MB/s':>8}  result")
+    for fixture, old, new, expect in CASES:
+        with open(os.path.join(FIXTURES, fixture), encoding="utf-8") as f:
+            text = f.read()
+        size = len(text.encode("utf-8"))
+        for label, fn in (("old", old), ("new", new)):
+            result = check(fn, text, expect)
+            if result.startswith("error"):
+                rate = 0.0
+            else:
+                rate = args.number / min(
+                    timeit.repeat(lambda: fn(text), number=args.number, repeat=5)
+                )
+            print(f"{fixture:<22}{label:<6}{rate:>10.0f}{rate * size / 1e6:>8.1f}  {result}")
+
+
+if __name__ == "__main__":
+    main()
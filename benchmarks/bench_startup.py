@@ -0,0 +1,99 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Cold start benchmark.
+
+Every case runs in a fresh interpreter, best of ``--repeat`` runs is kept.
+Run from the repository root:
+
+    python benchmarks/bench_startup.py [--repeat 10] [--top 15]
+"""
+import argparse
+import os
+import subprocess
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Modules that only some code paths need, and must not be loaded up front.
+LAZY_MODULES = ("PySide2", "lxml", "html2text", "aiohttp", "asyncio", "multiprocessing")
+
+CASES = [
+    ("python", "pass"),
+    ("import spider", "import spider"),
+    ("create spider", "import spider; spider.RenrenSpider()"),
+    ("import sync engine", "import spider; spider.get_spider_class('sync')"),
+    ("import async engine", "import spider; spider.get_spider_class('async')"),
+    ("import GUI module", "import renren_dumps"),
+]
+
+
+def run(code: str) -> float:
+    started = time.perf_counter()
+    subprocess.run([sys.executable, "-c", code], cwd=ROOT, check=True)
+    return time.perf_counter() - started
+
+
+def loaded_modules(code: str) -> list:
+    check = (
+        f"{code}\nimport sys\n"
+        f"print(' '.join(m for m in {LAZY_MODULES!r} if m in sys.modules))"
+    )
+    output = subprocess.run(
+        [sys.executable, "-c", check], cwd=ROOT, check=True, stdout=subprocess.PIPE
+    ).stdout.decode()
+    return output.split()
+
+
+def import_profile(code: str, top: int) -> list:
+    """Return the ``top`` slowest modules imported directly by the modules
+    ``code`` imports, by cumulative time.
+    """
+    stderr = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", code],
+        cwd=ROOT, check=True, stderr=subprocess.PIPE,
+    ).stderr.decode()
+    rows = []
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        _, cumulative, name = line.split("|")
+        # Each level of nesting indents the name by two more spaces.
+        depth = (len(name) - len(name.lstrip())) // 2
+        if cumulative.strip().isdigit() and depth == 1:
+            rows.append((int(cumulative), name.strip()))
+    return sorted(rows, reverse=True)[:top]
+
+
+def available(code: str) -> bool:
+    return subprocess.run(
+        [sys.executable, "-c", code], cwd=ROOT,
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+    ).returncode == 0
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--repeat", type=int, default=10, help="Runs per case")
+    parser.add_argument("--top", type=int, default=10, help="Slowest imports to list")
+    args = parser.parse_args()
+
+    print(f"{'case':<22}{'best ms':>9}{'median ms':>11}  heavy modules loaded")
+    for label, code in CASES:
+        if not available(code):
+            print(f"{label:<22}{'skipped, dependencies missing':>20}")
+            continue
+        times = sorted(run(code) for _ in range(args.repeat))
+        loaded = ", ".join(loaded_modules(code)) or "-"
+        print(
+            f"{label:<22}{times[0] * 1000:>9.1f}"
+            f"{times[len(times) // 2] * 1000:>11.1f}  {loaded}"
+        )
+
+    print("\nSlowest imports of 'import spider' (cumulative ms):")
+    for cumulative, name in import_profile("import spider", args.top):
+        print(f"{cumulative / 1000:>8.1f}  {name}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,119 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Kill an archive dump halfway and check that resuming it completes it.
+
+The albums are dumped against the mock server until it has sent
+``--kill-at`` of the photo bytes, the process is then killed without a
+chance to close the archive. A second run resumes the dump, after which the
+archive has to open and hold every photo at its full size. Run from the
+repository root:
+
+    python benchmarks/kill_resume.py --output-format zip
+    python benchmarks/kill_resume.py --output-format tar --engine async
+
+The exit status is 1 when the resumed archive is missing photos.
+"""
+import argparse
+import os
+import shutil
+import subprocess
+import sys
+import tarfile
+import tempfile
+import time
+import zipfile
+from typing import Dict
+
+from bench_dump import free_port, server_stats, start_server
+from mock_server import add_arguments
+
+
+def dump_command(args: argparse.Namespace, output: str) -> list:
+    return [
+        sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), "bench_dump.py"),
+        "--run-one", "--category", "albums", "--engine", args.engine,
+        "--output", output, "--output-format", args.output_format,
+    ]
+
+
+def archive_members(path: str, output_format: str) -> Dict[str, int]:
+    """Return the sizes of the regular files in an archive by name."""
+    if output_format == "zip":
+        with zipfile.ZipFile(path) as archive:
+            bad = archive.testzip()
+            if bad is not None:
+                raise zipfile.BadZipFile(f"CRC mismatch in {bad}")
+            return {info.filename: info.file_size for info in archive.infolist()}
+    if output_format == "tar":
+        with tarfile.open(path) as archive:
+            return {m.name: m.size for m in archive if m.isfile()}
+    import zstandard
+
+    with open(path, "rb") as f, \
+            zstandard.ZstdDecompressor().stream_reader(f, read_across_frames=True) as reader, \
+            tarfile.open(fileobj=reader, mode="r|", ignore_zeros=True) as archive:
+        return {m.name: m.size for m in archive if m.isfile()}
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--engine", default="sync", help="Crawl engine to test")
+    parser.add_argument(
+        "--output-format", default="zip", choices=("zip", "tar", "tar.zst"),
+        help="Archive format to test",
+    )
+    parser.add_argument(
+        "--kill-at", type=float, default=0.5,
+        help="Fraction of the photo bytes sent before the kill, defaults to 0.5",
+    )
+    add_arguments(parser)
+    args = parser.parse_args()
+
+    expected = args.albums * args.photos
+    port = free_port()
+    server = start_server(args, port)
+    output = tempfile.mkdtemp(prefix="renren-kill-")
+    # Archive dumps keep their state outside the output, in the temporary
+    # directory here so it is removed with it.
+    env = dict(
+        os.environ, HTTP_PROXY=f"http://127.0.0.1:{port}", NO_PROXY="",
+        XDG_STATE_HOME=os.path.join(output, ".state"), LOCALAPPDATA="",
+    )
+    path = os.path.join(output, f"renren-1.{args.output_format}")
+    try:
+        dump = subprocess.Popen(
+            dump_command(args, output), env=env, cwd=output, stdout=subprocess.DEVNULL
+        )
+        threshold = expected * args.photo_size * args.kill_at
+        while dump.poll() is None:
+            if server_stats(port)["bytes"] >= threshold:
+                dump.kill()
+                break
+            time.sleep(0.01)
+        if dump.wait() == 0:
+            sys.exit("The dump finished before it was killed, use more photos")
+        killed_at = os.path.getsize(path)
+        before = server_stats(port)
+        subprocess.run(
+            dump_command(args, output), env=env, cwd=output, check=True,
+            stdout=subprocess.DEVNULL,
+        )
+        requests = server_stats(port)["requests"] - before["requests"]
+        members = archive_members(path, args.output_format)
+    finally:
+        server.terminate()
+        server.wait()
+        shutil.rmtree(output, ignore_errors=True)
+
+    photos = {name: size for name, size in members.items() if name.startswith("albums/")}
+    short = [name for name, size in photos.items() if size != args.photo_size]
+    print(
+        f"killed at {killed_at / 1e6:.1f} MB, resumed with {requests} requests, "
+        f"{len(photos)} of {expected} photos, {len(short)} short"
+    )
+    if len(photos) != expected or short:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
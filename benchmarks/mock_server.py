@@ -0,0 +1,306 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""A local stand-in for the renren endpoints used by the spider.
+
+It is meant to be used as an HTTP proxy, so the spider keeps requesting the
+real URLs:
+
+    python benchmarks/mock_server.py --port 8765 --albums 10
+    HTTP_PROXY=http://127.0.0.1:8765 python spider.py ...
+
+Photos get unique content derived from their URL, so deduplication only
+kicks in for the fraction of photos marked shared with ``--shared``. With
+``--shared-urls`` those are also listed under the same URL in every album.
+``GET /__stats`` on any host returns the requests and bytes served so far.
+"""
+import argparse
+import hashlib
+import json
+import random
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Optional, Tuple, Union
+from urllib.parse import parse_qs, urlsplit
+
+
+# Photos never change, so every one has the same modification time.
+LAST_MODIFIED = "Mon, 14 Nov 2018 00:00:00 GMT"
+
+
+class Dataset:
+    ARTICLES_PER_PAGE = 10
+    STATUS_PER_PAGE = 20
+
+    def __init__(
+        self, *, albums: int = 3, photos: int = 150, photo_size: int = 50_000,
+        shared: float = 0.0, shared_urls: bool = False, articles: int = 25,
+        article_size: int = 4_000, statuses: int = 45,
+    ) -> None:
+        self.albums = albums
+        self.photos = photos
+        self.photo_size = photo_size
+        self.shared = shared
+        self.shared_urls = shared_urls
+        self.articles = articles
+        self.article_size = article_size
+        self.statuses = statuses
+
+    def album_list(self, offset: int, limit: int) -> str:
+        albums = [
+            {
+                "albumId": str(1000 + i),
+                "ownerId": 1,
+                "albumName": f"album {i}",
+                "photoCount": self.photos,
+                "cover": {"url": f"http://fmn.rrimg.com/cover/{i}.jpg", "size": [200, 150]},
+            }
+            for i in range(offset, min(offset + limit, self.albums))
+        ]
+        return (
+            "<html><body><script>nx.data.photo = {'albumList': "
+            f"{json.dumps(albums)}, 'albumCount': {self.albums}}};</script></body></html>"
+        )
+
+    def album_page(self, album_id: str, page: int, page_size: int) -> str:
+        start = (page - 1) * page_size
+        photos = [
+            {"url": f"http://fmn.rrimg.com/{self.photo_dir(album_id, i)}/p{i}.jpg"}
+            for i in range(start, min(start + page_size, self.photos))
+        ]
+        return json.dumps({"photoList": photos})
+
+    def photo_dir(self, album_id: str, index: int) -> str:
+        if self.shared_urls and index < self.photos * self.shared:
+            return "shared"
+        return album_id
+
+    def photo(self, path: str) -> bytes:
+        index = int(path.rsplit("/p", 1)[-1].split(".")[0])
+        # The same photo number in every album is shared.
+        if index < self.photos * self.shared:
+            path = f"shared/{index}"
+        seed = hashlib.sha256(path.encode()).digest()
+        return (seed * (self.photo_size // len(seed) + 1))[:self.photo_size]
+
+    def article_list(self, page: int) -> str:
+        start = page * self.ARTICLES_PER_PAGE
+        end = min(start + self.ARTICLES_PER_PAGE, self.articles)
+        # Newest first, like the real list.
+        items = "".join(
+            f'<div><a href="http://3g.renren.com/blog/content.do?id={i}&amp;flag=0">'
+            f"title {i}</a><p>2010-01-{i % 28 + 1:02d} 12:00</p></div>"
+            for i in range(self.articles - 1 - start, self.articles - 1 - end, -1)
+        )
+        next_link = ""
+        if end < self.articles:
+            next_link = (
+                '<a title="下一页" href="http://3g.renren.com/blog/wmyblog.do'
+                f'?id=1&amp;curpage={page + 1}">下一页</a>'
+            )
+        return f'<html><body><div class="list">{items}</div>{next_link}</body></html>'
+
+    def article(self, article_id: str) -> str:
+        paragraph = f"<p>article <b>{article_id}</b> <i>text</i> body.</p>"
+        body = paragraph * (self.article_size // len(paragraph) + 1)
+        return (
+            f'<html><body><div class="blog"><div class="con">{body}</div>'
+            '<div class="comments"><div>comment</div></div></div></body></html>'
+        )
+
+    def status_page(self, page: int) -> str:
+        start = page * self.STATUS_PER_PAGE
+        items = [
+            {
+                "id": i,
+                "dtime": f"2011-01-{i % 28 + 1:02d} {i % 24:02d}:00",
+                "content": f"status <i>{i}</i> <a href='http://www.renren.com'>link</a>",
+                "location": f"city {i}" if i % 2 else "",
+            }
+            for i in range(
+                self.statuses - start, max(self.statuses - start - self.STATUS_PER_PAGE, 0), -1
+            )
+        ]
+        return json.dumps({"count": self.statuses, "doingArray": items})
+
+
+class MockHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args) -> None:
+        pass
+
+    def do_GET(self) -> None:
+        server = self.server
+        url = urlsplit(self.path)
+        host = url.hostname or self.headers.get("Host", "").split(":")[0]
+        query = {k: v[0] for k, v in parse_qs(url.query).items()}
+        if url.path == "/__stats":
+            with server.lock:
+                stats = {"requests": server.requests, "bytes": server.bytes_sent}
+            return self.send(json.dumps(stats), "application/json", count=False)
+        if server.latency:
+            time.sleep(server.latency)
+        if server.error_rate and random.random() < server.error_rate:
+            return self.send("Service Unavailable", code=503)
+        found = self.route(host, url.path, query)
+        if found is None:
+            return self.send("Not Found", code=404)
+        if host == "fmn.rrimg.com":
+            return self.send_photo(found[0])
+        self.send(*found)
+
+    def send_photo(self, body: bytes) -> None:
+        """Send a photo with validators, honouring Range and If-Range."""
+        etag = f'"{hashlib.sha1(body).hexdigest()}"'
+        headers = {"ETag": etag, "Last-Modified": LAST_MODIFIED, "Accept-Ranges": "bytes"}
+        code, start = 200, 0
+        ranges = self.headers.get("Range", "")
+        if ranges.startswith("bytes=") and self.headers.get("If-Range", etag) in (
+            etag, LAST_MODIFIED
+        ):
+            start = int(ranges[len("bytes="):].split("-")[0])
+            if start >= len(body):
+                return self.send("Range Not Satisfiable", code=416)
+            code = 206
+            headers["Content-Range"] = f"bytes {start}-{len(body) - 1}/{len(body)}"
+        limit = None
+        if self.server.drop_rate and random.random() < self.server.drop_rate:
+            # Announce the whole body but hang up halfway through it.
+            limit = (len(body) - start) // 2
+            self.close_connection = True
+        self.send(body[start:], "image/jpeg", code, headers=headers, limit=limit)
+
+    def route(self, host: str, path: str, query: dict) -> Optional[Tuple[Union[str, bytes], str]]:
+        data = self.server.dataset
+        if host == "photo.renren.com" and path.endswith("/albumlist/v7"):
+            offset, limit = int(query.get("offset", 0)), int(query.get("limit", 40))
+            return data.album_list(offset, limit), "text/html; charset=utf-8"
+        if host == "photo.renren.com" and "/bypage/" in path:
+            album_id = path.split("album-")[1].split("/")[0]
+            return (
+                data.album_page(album_id, int(query["page"]), int(query["pageSize"])),
+                "application/json",
+            )
+        if host == "fmn.rrimg.com":
+            return data.photo(path), "image/jpeg"
+        if host == "3g.renren.com" and path == "/blog/wmyblog.do":
+            return data.article_list(int(query.get("curpage", 0))), "text/html; charset=utf-8"
+        if host == "3g.renren.com" and path == "/blog/content.do":
+            return data.article(query["id"]), "text/html; charset=utf-8"
+        if host == "status.renren.com" and path == "/GetSomeomeDoingList.do":
+            return data.status_page(int(query["curpage"])), "application/json"
+        return None
+
+    def send(
+        self, body: Union[str, bytes], content_type: str = "text/plain",
+        code: int = 200, count: bool = True, headers: Optional[dict] = None,
+        limit: Optional[int] = None,
+    ) -> None:
+        if isinstance(body, str):
+            body = body.encode("utf-8")
+        self.send_response(code)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        chunk_size = 16 * 1024
+        sent = body if limit is None else body[:limit]
+        for start in range(0, len(sent), chunk_size):
+            chunk = sent[start:start + chunk_size]
+            if self.server.bandwidth:
+                time.sleep(len(chunk) / self.server.bandwidth)
+            self.wfile.write(chunk)
+        if not count:
+            return
+        with self.server.lock:
+            self.server.requests += 1
+            self.server.bytes_sent += len(sent)
+
+
+class MockServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(
+        self, address: Tuple[str, int] = ("127.0.0.1", 0), *,
+        dataset: Optional[Dataset] = None, latency: float = 0.01,
+        bandwidth: Optional[float] = None, error_rate: float = 0.0,
+        drop_rate: float = 0.0,
+    ) -> None:
+        super().__init__(address, MockHandler)
+        self.dataset = dataset or Dataset()
+        # Seconds added to every request.
+        self.latency = latency
+        # Bytes per second of each response, None for unlimited.
+        self.bandwidth = bandwidth
+        # Fraction of requests answered with a 503.
+        self.error_rate = error_rate
+        # Fraction of photo responses cut off halfway.
+        self.drop_rate = drop_rate
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.bytes_sent = 0
+
+    def handle_error(self, request, client_address) -> None:
+        # Clients drop idle keep-alive connections when they exit.
+        if not isinstance(sys.exc_info()[1], ConnectionError):
+            super().handle_error(request, client_address)
+
+    @property
+    def proxy_url(self) -> str:
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self) -> threading.Thread:
+        thread = threading.Thread(target=self.serve_forever, daemon=True)
+        thread.start()
+        return thread
+
+
+def add_arguments(parser: argparse.ArgumentParser) -> None:
+    parser.add_argument("--albums", type=int, default=3, help="Number of albums")
+    parser.add_argument("--photos", type=int, default=150, help="Photos per album")
+    parser.add_argument("--photo-size", type=int, default=50_000, help="Bytes per photo")
+    parser.add_argument(
+        "--shared", type=float, default=0.0,
+        help="Fraction of photos with the same content in every album",
+    )
+    parser.add_argument(
+        "--shared-urls", action="store_true",
+        help="List the shared photos under the same URL in every album",
+    )
+    parser.add_argument("--articles", type=int, default=25, help="Number of articles")
+    parser.add_argument("--article-size", type=int, default=4_000, help="Bytes per article body")
+    parser.add_argument("--statuses", type=int, default=45, help="Number of status entries")
+    parser.add_argument("--latency", type=float, default=0.01, help="Seconds per request")
+    parser.add_argument("--bandwidth", type=float, help="Bytes per second per response")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Fraction of 503 answers")
+    parser.add_argument(
+        "--drop-rate", type=float, default=0.0,
+        help="Fraction of photo responses cut off halfway",
+    )
+
+
+def server_from_args(args: argparse.Namespace, port: int = 0) -> MockServer:
+    dataset = Dataset(
+        albums=args.albums, photos=args.photos, photo_size=args.photo_size,
+        shared=args.shared, shared_urls=args.shared_urls, articles=args.articles,
+        article_size=args.article_size, statuses=args.statuses,
+    )
+    return MockServer(
+        ("127.0.0.1", port), dataset=dataset, latency=args.latency,
+        bandwidth=args.bandwidth, error_rate=args.error_rate, drop_rate=args.drop_rate,
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--port", type=int, default=8765, help="Port to listen on")
+    add_arguments(parser)
+    args = parser.parse_args()
+    server = server_from_args(args, args.port)
+    print(f"Serving on {server.proxy_url}")
+    server.serve_forever()
@@ -0,0 +1,237 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import contextlib
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import threading
+from typing import IO, Iterator, Mapping, Optional, Tuple
+
+
+class IncompleteDownload(Exception):
+    """A download ended with a different length than the server announced."""
+
+
+def hash_file(path: str, chunk_size: int = 1024 * 1024) -> Tuple[str, int]:
+    """Return the SHA-256 and size of a file."""
+    digest = hashlib.sha256()
+    size = 0
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+            size += len(chunk)
+    return digest.hexdigest(), size
+
+
+class BlobWriter:
+    def __init__(self, f) -> None:
+        self._f = f
+        self._hash = hashlib.sha256()
+        self.size = 0
+        self.digest: Optional[str] = None
+
+    def write(self, chunk: bytes) -> None:
+        self._f.write(chunk)
+        self._hash.update(chunk)
+        self.size += len(chunk)
+
+    def finish(self) -> str:
+        self.digest = self._hash.hexdigest()
+        return self.digest
+
+
+class BlobStore:
+    """Photos stored once under their SHA-256, album files link to them.
+
+    Layout is ``<root>/ab/abcdef...``. Unfinished downloads live in
+    ``<root>/tmp`` and only move into place once complete. On filesystems
+    without hardlinks a blob is moved out to the first album file instead,
+    and ``<root>/ab/abcdef....ref`` points there.
+    """
+
+    REF_SUFFIX = ".ref"
+
+    def __init__(self, root: str) -> None:
+        self.root = root
+        self.tmp_dir = os.path.join(root, "tmp")
+        os.makedirs(self.tmp_dir, exist_ok=True)
+        self._lock = threading.Lock()
+
+    def path(self, digest: str) -> str:
+        return os.path.join(self.root, digest[:2], digest)
+
+    def locate(self, digest: str) -> Optional[str]:
+        """Return the file holding the content of a blob, None if there is
+        none.
+        """
+        path = self.path(digest)
+        if os.path.isfile(path):
+            return path
+        try:
+            with open(f"{path}{self.REF_SUFFIX}", encoding="utf-8") as f:
+                moved = os.path.join(self.root, f.read())
+        except OSError:
+            return None
+        return moved if os.path.isfile(moved) else None
+
+    def has(self, digest: str) -> bool:
+        return self.locate(digest) is not None
+
+    @contextlib.contextmanager
+    def writer(self) -> Iterator[BlobWriter]:
+        fd, tmp_path = tempfile.mkstemp(dir=self.tmp_dir, suffix=".part")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                blob = BlobWriter(f)
+                yield blob
+            path = self.path(blob.finish())
+            if self.has(blob.digest):
+                os.remove(tmp_path)
+            else:
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                os.replace(tmp_path, path)
+        except BaseException:
+            with contextlib.suppress(OSError):
+                os.remove(tmp_path)
+            raise
+
+    def adopt(self, path: str) -> Tuple[str, int]:
+        """Move a finished file into the store, return its digest and size."""
+        digest, size = hash_file(path)
+        dest = self.path(digest)
+        if self.has(digest):
+            os.remove(path)
+        else:
+            os.makedirs(os.path.dirname(dest), exist_ok=True)
+            os.replace(path, dest)
+        return digest, size
+
+    def link(self, digest: str, dest: str) -> None:
+        """Make ``dest`` a hardlink of the blob.
+
+        Where the filesystem has no hardlinks, the first ``dest`` gets the
+        blob itself rather than a copy, so the content isn't stored twice.
+        Later ones are copies of that file.
+        """
+        src = self.locate(digest)
+        if src is None:
+            raise FileNotFoundError(self.path(digest))
+        part_path = f"{dest}.part"
+        with contextlib.suppress(OSError):
+            os.remove(part_path)
+        try:
+            os.link(src, part_path)
+        except OSError:
+            with self._lock:
+                if self._move_out(digest, dest):
+                    return
+                src = self.locate(digest)
+            shutil.copyfile(src, part_path)
+        os.replace(part_path, dest)
+
+    def _move_out(self, digest: str, dest: str) -> bool:
+        path = self.path(digest)
+        if not os.path.isfile(path):
+            return False
+        # The reference goes first, a blob is never left without one.
+        ref_path = f"{path}{self.REF_SUFFIX}"
+        with open(f"{ref_path}.tmp", "w", encoding="utf-8") as f:
+            f.write(os.path.relpath(dest, self.root))
+        os.replace(f"{ref_path}.tmp", ref_path)
+        os.replace(path, dest)
+        return True
+
+
+class PartialDownload:
+    """A download that survives interruptions.
+
+    The body goes to ``<root>/<key>.part``, and ``<key>.json`` records the
+    URL, the full length and the validators of the response. A later
+    attempt, in this run or the next one, asks for the rest with a Range
+    request. The server only answers with a range if the resource still
+    matches the validators.
+    """
+
+    def __init__(self, root: str, url: str) -> None:
+        self.root = root
+        self.url = url
+        key = hashlib.sha1(url.encode("utf-8")).hexdigest()
+        self.path = os.path.join(root, f"{key}.part")
+        self.meta_path = os.path.join(root, f"{key}.json")
+        self.meta = {}
+        self.size = 0
+        with contextlib.suppress(OSError, ValueError):
+            with open(self.meta_path, encoding="utf-8") as f:
+                self.meta = json.load(f)
+            self.size = os.path.getsize(self.path)
+
+    @property
+    def validator(self) -> Optional[str]:
+        # If-Range only accepts a strong ETag.
+        etag = self.meta.get("etag")
+        if etag and not etag.startswith("W/"):
+            return etag
+        return self.meta.get("last_modified")
+
+    def complete(self) -> bool:
+        return bool(self.meta) and self.size == self.meta.get("length")
+
+    def resume_headers(self) -> dict:
+        if not self.size or not self.validator or self.meta.get("url") != self.url:
+            return {}
+        return {"Range": f"bytes={self.size}-", "If-Range": self.validator}
+
+    def begin(self, status: int, headers: Mapping[str, str]) -> Optional[IO]:
+        """Open the part file for the body of a response.
+
+        The body is appended when it is the requested range, otherwise the
+        part starts over. None is returned for a range that doesn't continue
+        the part, which is then discarded.
+        """
+        if status == 206:
+            start, _, length = headers.get("Content-Range", "").partition(" ")[2].partition("/")
+            if (
+                not self.size or start.partition("-")[0] != str(self.size)
+                or not length.isdigit() or int(length) != self.meta.get("length")
+            ):
+                self.discard()
+                return None
+            return open(self.path, "ab")
+        length = headers.get("Content-Length")
+        self.meta = {
+            "url": self.url,
+            "length": int(length) if length and length.isdigit() else None,
+            "etag": headers.get("ETag"),
+            "last_modified": headers.get("Last-Modified"),
+        }
+        self.size = 0
+        os.makedirs(self.root, exist_ok=True)
+        with open(f"{self.meta_path}.tmp", "w", encoding="utf-8") as f:
+            json.dump(self.meta, f)
+        os.replace(f"{self.meta_path}.tmp", self.meta_path)
+        return open(self.path, "wb")
+
+    def finish(self) -> None:
+        """Check the part has exactly the announced length.
+
+        A short part is kept for the next attempt to resume, a longer one
+        can't be trusted and is discarded.
+        """
+        with contextlib.suppress(OSError):
+            self.size = os.path.getsize(self.path)
+        expected = self.meta.get("length")
+        if expected is None or self.size == expected:
+            return
+        error = IncompleteDownload(f"{self.url}: got {self.size} of {expected} bytes")
+        if self.size > expected:
+            self.discard()
+        raise error
+
+    def discard(self) -> None:
+        for path in (self.path, self.meta_path):
+            with contextlib.suppress(OSError):
+                os.remove(path)
+        self.meta = {}
+        self.size = 0
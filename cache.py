@@ -0,0 +1,107 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""On-disk cache of the listing and page responses of a dump.
+
+Photos are not cached, they are already kept in the output. What is cached
+is the text the Markdown and status output is rendered from, so an offline
+run can render it again without the network.
+"""
+import sqlite3
+import threading
+import time
+import zlib
+from typing import Optional
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS responses (
+    url TEXT PRIMARY KEY,
+    body BLOB NOT NULL,
+    size INTEGER NOT NULL,
+    accessed_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS responses_accessed_at ON responses (accessed_at);
+"""
+
+
+class ResponseCache:
+    """Response bodies by URL, compressed, with least recently used entries
+    evicted once the total size goes over ``max_size`` bytes.
+    """
+
+    FILENAME = ".renren_cache.db"
+    DEFAULT_MAX_SIZE = 256 * 1024 * 1024
+    # Eviction frees a little more than needed, so it doesn't run on every put.
+    EVICT_TO = 0.9
+
+    def __init__(self, path: str, max_size: int = DEFAULT_MAX_SIZE) -> None:
+        self.path = path
+        self.max_size = max_size
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript(SCHEMA)
+        self._conn.commit()
+        self.size = self._conn.execute(
+            "SELECT COALESCE(SUM(size), 0) FROM responses"
+        ).fetchone()[0]
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
+
+    def get(self, url: str) -> Optional[str]:
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT body FROM responses WHERE url = ?", (url,)
+            ).fetchone()
+            if row is None:
+                return None
+            self._conn.execute(
+                "UPDATE responses SET accessed_at = ? WHERE url = ?", (time.time(), url)
+            )
+            self._conn.commit()
+        return zlib.decompress(row[0]).decode("utf-8")
+
+    def put(self, url: str, text: str) -> None:
+        body = zlib.compress(text.encode("utf-8"))
+        if len(body) > self.max_size:
+            return
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT size FROM responses WHERE url = ?", (url,)
+            ).fetchone()
+            self._conn.execute(
+                "INSERT OR REPLACE INTO responses (url, body, size, accessed_at) "
+                "VALUES (?, ?, ?, ?)",
+                (url, body, len(body), time.time()),
+            )
+            self.size += len(body) - (row[0] if row else 0)
+            if self.size > self.max_size:
+                self._evict(self.size - int(self.max_size * self.EVICT_TO))
+            self._conn.commit()
+
+    def discard(self, prefix: str) -> None:
+        """Drop the responses of every URL starting with ``prefix``."""
+        condition = "substr(url, 1, ?) = ?"
+        args = (len(prefix), prefix)
+        with self._lock:
+            freed = self._conn.execute(
+                f"SELECT COALESCE(SUM(size), 0) FROM responses WHERE {condition}", args
+            ).fetchone()[0]
+            self._conn.execute(f"DELETE FROM responses WHERE {condition}", args)
+            self.size -= freed
+            self._conn.commit()
+
+    def _evict(self, nbytes: int) -> None:
+        freed = 0
+        urls = []
+        for url, size in self._conn.execute(
+            "SELECT url, size FROM responses ORDER BY accessed_at"
+        ):
+            if freed >= nbytes:
+                break
+            urls.append((url,))
+            freed += size
+        self._conn.executemany("DELETE FROM responses WHERE url = ?", urls)
+        self.size -= freed
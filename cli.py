@@ -0,0 +1,350 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Command line interface, for dumping without the GUI.
+
+    python cli.py --email EMAIL --password PASSWORD -o output
+    python cli.py --batch accounts.txt --jobs 4 -o archive
+
+A batch file lists one account per line. ``USER_ID`` dumps that user with
+the session of the command line (``--email``/``--password`` or the saved
+one), ``EMAIL,PASSWORD[,USER_ID]`` logs in as that account first. Blank
+lines and lines starting with ``#`` are skipped. Each account is dumped to
+``<output>/<user_id>`` by its own worker process with its own session.
+"""
+import argparse
+import csv
+import os
+import pickle
+import shutil
+import sys
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from typing import Dict, List, Optional
+
+import spider
+from progress import Progress, describe, format_duration, format_size
+from writers import OUTPUT_FORMATS
+
+
+class TextProgress(Progress):
+    """Prints progress from a background thread.
+
+    On a terminal the status line is redrawn in place, otherwise a line is
+    logged every LOG_INTERVAL seconds.
+    """
+
+    TTY_INTERVAL = 0.2
+    LOG_INTERVAL = 5.0
+
+    def __init__(self, spider_, stream=sys.stderr, prefix: str = "") -> None:
+        super().__init__(spider_)
+        self.stream = stream
+        self.prefix = prefix
+        self.tty = stream.isatty()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self) -> None:
+        self.started = time.monotonic()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self.write(self.render(), final=True)
+
+    def render(self) -> str:
+        snapshot = self.snapshot()
+        line = f"{self.prefix}{describe(snapshot)}"
+        if snapshot["active"]:
+            line += f" | {snapshot['active'][0]}"
+        return line
+
+    def write(self, line: str, final: bool = False) -> None:
+        if self.tty:
+            width = shutil.get_terminal_size().columns - 1
+            self.stream.write(f"\r\x1b[K{line[:width]}")
+            if final:
+                self.stream.write("\n")
+        else:
+            self.stream.write(f"{line}\n")
+        self.stream.flush()
+
+    def _run(self) -> None:
+        interval = self.TTY_INTERVAL if self.tty else self.LOG_INTERVAL
+        while not self._stop.wait(interval):
+            self.write(self.render())
+
+
+def parse_size(value: str) -> float:
+    """Parse a byte count such as ``512K`` or ``2M``."""
+    units = {"K": 1024, "M": 1024 ** 2, "G": 1024 ** 3}
+    value = value.strip().upper().rstrip("B")
+    if value and value[-1] in units:
+        return float(value[:-1]) * units[value[-1]]
+    return float(value)
+
+
+def login(instance, email: Optional[str], password: Optional[str], keep: bool = False) -> None:
+    """Log in with the given credentials, or fall back to the saved session.
+
+    A captcha is asked for on the terminal when there is one.
+    """
+    if not email:
+        if instance.is_login():
+            return
+        raise SystemExit(
+            "Not logged in: pass --email and --password, add --keep to save the session"
+        )
+    icode = ""
+    while True:
+        try:
+            instance.login(email, password, icode, keep)
+            return
+        except spider.iCodeRequired as e:
+            if not sys.stdin.isatty():
+                raise
+            with open("icode.jpg", "wb") as f:
+                f.write(instance.get_icode_image())
+            icode = input(f"{e or 'Captcha required'}, enter the code in icode.jpg: ").strip()
+
+
+def read_accounts(path: str) -> List[Dict[str, str]]:
+    accounts = []
+    with open(path, encoding="utf-8", newline="") as f:
+        for row in csv.reader(f):
+            row = [field.strip() for field in row]
+            if not row or not row[0] or row[0].startswith("#"):
+                continue
+            if len(row) == 1:
+                accounts.append({"user_id": row[0]})
+            elif len(row) in (2, 3):
+                account = {"email": row[0], "password": row[1]}
+                if len(row) == 3 and row[2]:
+                    account["user_id"] = row[2]
+                accounts.append(account)
+            else:
+                raise ValueError(f"Can't read account line: {','.join(row)}")
+    return accounts
+
+
+def spider_params(args: argparse.Namespace) -> Dict[str, object]:
+    return {
+        "concurrency": args.concurrency,
+        "bandwidth": args.bandwidth,
+        "categories": args.category,
+        "output_format": args.format,
+        "refresh": args.refresh,
+        "cache_size": args.cache_size,
+        "offline": args.offline,
+        "incremental": args.incremental,
+        "transport": args.transport,
+        "work_dir": args.work_dir,
+    }
+
+
+def dump_account(account: Dict[str, str], options: Dict[str, object]) -> Dict[str, object]:
+    """Dump one account of a batch, run in a worker process."""
+    name = account.get("user_id") or account["email"]
+    result = {"account": name, "error": None}
+    try:
+        instance = spider.get_spider_class(options["engine"])()
+        offline = options["params"]["offline"]
+        if account.get("email") and not (offline and account.get("user_id")):
+            instance.login(account["email"], account["password"])
+        elif options["cookies"]:
+            instance.s.cookies = pickle.loads(options["cookies"])
+        user_id = account.get("user_id") or instance.user_id
+        output_dir = os.path.join(options["output"], str(user_id))
+        params = dict(options["params"])
+        if options["metrics_file"]:
+            params["metrics_file"] = os.path.join(output_dir, options["metrics_file"])
+        if params["work_dir"]:
+            # Each account of a batch has its own state.
+            params["work_dir"] = os.path.join(params["work_dir"], str(user_id))
+        instance.set_params(user_id=user_id, output_dir=output_dir, **params)
+        progress = TextProgress(instance, prefix=f"[{user_id}] ")
+        # Interleaved output of several processes can't share one status line.
+        progress.tty = False
+        progress.start()
+        try:
+            instance.main(progress)
+        finally:
+            progress.stop()
+        result.update(
+            user_id=user_id,
+            output=output_dir,
+            items=progress.snapshot()["current"],
+            bytes=instance.bytes_transferred,
+            seconds=time.monotonic() - progress.started,
+        )
+    except Exception as e:
+        result["error"] = f"{type(e).__name__}: {e}"
+    return result
+
+
+def run_single(args: argparse.Namespace) -> int:
+    instance = spider.get_spider_class(args.engine)()
+    instance.session_file = args.session
+    if not args.offline:
+        login(instance, args.email, args.password, args.keep)
+    elif not args.user and not instance.is_login():
+        raise SystemExit("Pass --user to render offline without a saved session")
+    instance.set_params(
+        user_id=args.user,
+        output_dir=args.output,
+        metrics_file=args.metrics_file,
+        metrics_port=args.metrics_port,
+        **spider_params(args),
+    )
+    progress = Progress(instance) if args.quiet else TextProgress(instance)
+    if not args.quiet:
+        progress.start()
+    try:
+        instance.main(progress)
+    except (KeyboardInterrupt, spider.Cancelled):
+        print("Cancelled", file=sys.stderr)
+        return 130
+    finally:
+        if not args.quiet:
+            progress.stop()
+    return 0
+
+
+def run_batch(args: argparse.Namespace) -> int:
+    accounts = read_accounts(args.batch)
+    if not accounts:
+        raise SystemExit(f"No accounts in {args.batch}")
+    if args.metrics_port:
+        raise SystemExit("--metrics-port can't be used with --batch")
+    cookies = None
+    if not args.offline and any("email" not in account for account in accounts):
+        instance = spider.RenrenSpider()
+        instance.session_file = args.session
+        login(instance, args.email, args.password, args.keep)
+        cookies = pickle.dumps(instance.s.cookies)
+    jobs = args.jobs or min(len(accounts), os.cpu_count() or 1)
+    params = spider_params(args)
+    # Keep the HTML conversion processes of all workers within the CPU count.
+    params["convert_workers"] = max(1, (os.cpu_count() or 1) // jobs)
+    options = {
+        "engine": args.engine,
+        "output": args.output,
+        "cookies": cookies,
+        "params": params,
+        "metrics_file": args.metrics_file and os.path.basename(args.metrics_file),
+    }
+    failed = 0
+    with ProcessPoolExecutor(jobs) as pool:
+        futures = [pool.submit(dump_account, account, options) for account in accounts]
+        for future in as_completed(futures):
+            result = future.result()
+            if result["error"]:
+                failed += 1
+                print(f"[{result['account']}] failed: {result['error']}", file=sys.stderr)
+            else:
+                print(
+                    f"[{result['user_id']}] done: {result['items']} items, "
+                    f"{format_size(result['bytes'])} in {format_duration(result['seconds'])}"
+                    f" -> {result['output']}",
+                    file=sys.stderr,
+                )
+    print(f"{len(accounts) - failed}/{len(accounts)} accounts dumped", file=sys.stderr)
+    return 1 if failed else 0
+
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(
+        description=__doc__.split("\n")[0],
+        epilog=__doc__.split("\n\n", 1)[1].split("\n\n", 1)[1],
+    )
+    parser.add_argument(
+        "-k", "--keep", action="store_true", help="Save the login cookies for later runs"
+    )
+    parser.add_argument(
+        "--session",
+        default=spider.RenrenSpider.SESSION_FILE,
+        help="File the login cookies are saved to and loaded from",
+    )
+    parser.add_argument("--user", help="User ID to dump, defaults to the logged in user")
+    parser.add_argument(
+        "--email",
+        default=os.getenv("RENREN_EMAIL"),
+        help="Login email, defaults to envvar RENREN_EMAIL",
+    )
+    parser.add_argument(
+        "--password",
+        default=os.getenv("RENREN_PASSWD"),
+        help="Login password, defaults to envvar RENREN_PASSWD",
+    )
+    parser.add_argument("-o", "--output", default="output", help="Output directory")
+    parser.add_argument(
+        "--engine",
+        default="sync",
+        choices=sorted(spider.ENGINES),
+        help="Crawl engine to use, defaults to sync",
+    )
+    parser.add_argument("-c", "--concurrency", type=int, help="Requests in flight")
+    parser.add_argument(
+        "--transport",
+        choices=spider.TRANSPORTS,
+        help="HTTP client of the sync engine, http2 needs httpx[http2], defaults to http1",
+    )
+    parser.add_argument(
+        "--bandwidth", type=parse_size, help="Download limit per second, e.g. 512K or 2M"
+    )
+    parser.add_argument(
+        "--category",
+        action="append",
+        choices=spider.RenrenSpider.CATEGORIES,
+        help="Category to dump, may be repeated, defaults to all",
+    )
+    parser.add_argument(
+        "--format", default="dir", choices=OUTPUT_FORMATS, help="Output format, defaults to dir"
+    )
+    parser.add_argument(
+        "--work-dir",
+        help="Where archive dumps keep their state, cache and partial downloads, "
+        "defaults to a directory under ~/.local/state",
+    )
+    parser.add_argument(
+        "--refresh", action="store_true", help="Re-list items finished by a previous run"
+    )
+    parser.add_argument(
+        "--cache-size",
+        type=parse_size,
+        help="Disk space for cached pages, e.g. 500M, 0 to disable, defaults to 256M",
+    )
+    parser.add_argument(
+        "--offline",
+        action="store_true",
+        help="Render articles and status again from cached pages, without the network",
+    )
+    parser.add_argument(
+        "--incremental",
+        action="store_true",
+        help="Only fetch the articles and status posted since the last run",
+    )
+    parser.add_argument("--metrics-file", help="Write a JSON metrics report to this file")
+    parser.add_argument(
+        "--metrics-port", type=int, help="Serve Prometheus metrics on this local port"
+    )
+    parser.add_argument("-q", "--quiet", action="store_true", help="Don't show progress")
+    parser.add_argument("--batch", help="File of accounts or user IDs to dump")
+    parser.add_argument(
+        "-j", "--jobs", type=int, help="Accounts dumped at once, defaults to the CPU count"
+    )
+    return parser
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    args = build_parser().parse_args(argv)
+    sys.exit(run_batch(args) if args.batch else run_single(args))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,115 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import threading
+from concurrent.futures import Future
+from typing import Any, Callable, List, Optional, Tuple
+
+Job = Tuple[Callable, tuple]
+
+
+def run_batch(jobs: List[Job]) -> List[Tuple[bool, Any]]:
+    results = []
+    for fn, args in jobs:
+        try:
+            results.append((True, fn(*args)))
+        except Exception as e:
+            results.append((False, e))
+    return results
+
+
+class Converter:
+    """Runs CPU bound rendering in a process pool, off the crawl threads.
+
+    Jobs are small, so they are grouped into batches of BATCH_SIZE before
+    being sent to a worker process. A batch that doesn't fill up is sent
+    after FLUSH_DELAY seconds. ``fn`` and its arguments must be picklable.
+    """
+
+    BATCH_SIZE = 16
+    FLUSH_DELAY = 0.02
+
+    def __init__(self, workers: Optional[int] = None) -> None:
+        # Imported here, it drags in multiprocessing.
+        import multiprocessing
+        from concurrent.futures import ProcessPoolExecutor
+
+        # Workers start on demand while the crawl threads run. A forked one
+        # could inherit a lock some thread held and wait on it forever, so
+        # they come from a fresh process instead.
+        method = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() \
+            else "spawn"
+        self._pool = ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context(method))
+        # Reentrant, futures failed under the lock run _done right away.
+        self._lock = threading.RLock()
+        self._batch: List[Tuple[Job, Future]] = []
+        self._timer: Optional[threading.Timer] = None
+        # Jobs submitted and not done yet.
+        self.pending = 0
+
+    def submit(self, fn: Callable, *args) -> Future:
+        future = Future()
+        future.add_done_callback(self._done)
+        with self._lock:
+            self.pending += 1
+            self._batch.append(((fn, args), future))
+            if len(self._batch) >= self.BATCH_SIZE:
+                self._flush()
+            elif self._timer is None:
+                self._timer = threading.Timer(self.FLUSH_DELAY, self.flush)
+                self._timer.daemon = True
+                self._timer.start()
+        return future
+
+    def _done(self, future: Future) -> None:
+        with self._lock:
+            self.pending -= 1
+
+    def flush(self) -> None:
+        with self._lock:
+            self._flush()
+
+    def _flush(self) -> None:
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if not self._batch:
+            return
+        # Futures cancelled while waiting are dropped, the rest can no longer
+        # be cancelled.
+        queued = [(job, f) for job, f in self._batch if f.set_running_or_notify_cancel()]
+        self._batch = []
+        if not queued:
+            return
+        jobs, futures = zip(*queued)
+        try:
+            batch = self._pool.submit(run_batch, list(jobs))
+        except RuntimeError as e:
+            # The pool is already shut down.
+            for future in futures:
+                future.set_exception(e)
+            return
+
+        def distribute(batch: Future) -> None:
+            try:
+                results = batch.result()
+            except BaseException as e:
+                for future in futures:
+                    future.set_exception(e)
+                return
+            for future, (ok, value) in zip(futures, results):
+                if ok:
+                    future.set_result(value)
+                else:
+                    future.set_exception(value)
+
+        batch.add_done_callback(distribute)
+
+    def shutdown(self) -> None:
+        self.flush()
+        self._pool.shutdown()
+
+    def __enter__(self) -> "Converter":
+        return self
+
+    def __exit__(self, exc_type, exc, tb) -> None:
+        self.shutdown()
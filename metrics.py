@@ -0,0 +1,235 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""In-process metrics for a dump run.
+
+Counters, gauges and histograms are keyed by name plus labels, as in
+Prometheus. A run's metrics can be dumped as a JSON report, or scraped live
+in the Prometheus text format from a local port.
+"""
+import bisect
+import contextlib
+import json
+import threading
+import time
+from concurrent.futures import Future
+from typing import Callable, Dict, Iterator, List, Optional, Tuple
+
+Labels = Tuple[Tuple[str, str], ...]
+Key = Tuple[str, Labels]
+
+# Upper bounds in seconds, good for anything from a parse to a large photo.
+LATENCY_BUCKETS = (
+    0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0,
+)
+
+
+class Histogram:
+    def __init__(self, buckets: Tuple[float, ...] = LATENCY_BUCKETS) -> None:
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def cumulative(self) -> List[Tuple[str, int]]:
+        total = 0
+        result = []
+        for bound, count in zip(self.buckets + (float("inf"),), self.counts):
+            total += count
+            result.append(("+Inf" if bound == float("inf") else repr(bound), total))
+        return result
+
+    def quantile(self, q: float) -> Optional[float]:
+        """Estimate a quantile by interpolating inside its bucket."""
+        if not self.count:
+            return None
+        rank = q * self.count
+        seen = 0
+        for i, count in enumerate(self.counts):
+            if count and seen + count >= rank:
+                lower = self.buckets[i - 1] if i else 0.0
+                upper = self.buckets[i] if i < len(self.buckets) else self.buckets[-1]
+                return lower + (upper - lower) * (rank - seen) / count
+            seen += count
+        return self.buckets[-1]
+
+
+def _key(name: str, labels: Dict[str, object]) -> Key:
+    return name, tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+def _format_labels(labels: Labels, extra: Labels = ()) -> str:
+    pairs = labels + extra
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{k}="{v}"' for k, v in pairs) + "}"
+
+
+class Metrics:
+    """Thread safe store for the metrics of one run."""
+
+    def __init__(self) -> None:
+        self.started = time.time()
+        self._lock = threading.Lock()
+        self._counters: Dict[Key, float] = {}
+        self._histograms: Dict[Key, Histogram] = {}
+        self._gauges: Dict[Key, Callable[[], float]] = {}
+        self._gauge_values: Dict[Key, float] = {}
+        self._gauge_max: Dict[Key, float] = {}
+        self._stop = threading.Event()
+        self._server = None
+
+    def inc(self, name: str, value: float = 1, **labels) -> None:
+        key = _key(name, labels)
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name: str, value: float, **labels) -> None:
+        key = _key(name, labels)
+        with self._lock:
+            if key not in self._histograms:
+                self._histograms[key] = Histogram()
+            self._histograms[key].observe(value)
+
+    @contextlib.contextmanager
+    def timer(self, name: str, **labels) -> Iterator[None]:
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - started, **labels)
+
+    def time_future(self, future: Future, name: str, **labels) -> Future:
+        """Observe the time until ``future`` is done."""
+        started = time.perf_counter()
+        future.add_done_callback(
+            lambda _: self.observe(name, time.perf_counter() - started, **labels)
+        )
+        return future
+
+    def record_request(
+        self, host: str, status: object, seconds: float, nbytes: int = 0
+    ) -> None:
+        self.inc("http_requests_total", host=host, status=status)
+        self.observe("http_request_seconds", seconds, host=host)
+        if nbytes:
+            self.inc("http_response_bytes_total", nbytes, host=host)
+
+    def gauge(self, name: str, fn: Callable[[], float], **labels) -> None:
+        """Register a gauge read from ``fn`` whenever the metrics are sampled."""
+        with self._lock:
+            self._gauges[_key(name, labels)] = fn
+
+    def sample(self) -> None:
+        with self._lock:
+            gauges = list(self._gauges.items())
+        values = {key: fn() for key, fn in gauges}
+        with self._lock:
+            for key, value in values.items():
+                self._gauge_values[key] = value
+                self._gauge_max[key] = max(value, self._gauge_max.get(key, value))
+
+    def start_sampler(self, interval: float = 0.5) -> None:
+        """Sample gauges in the background, so their peaks are recorded."""
+        def run() -> None:
+            while not self._stop.wait(interval):
+                self.sample()
+
+        threading.Thread(target=run, daemon=True).start()
+
+    def report(self) -> Dict[str, object]:
+        self.sample()
+        with self._lock:
+            counters: Dict[str, list] = {}
+            for (name, labels), value in sorted(self._counters.items()):
+                counters.setdefault(name, []).append({"labels": dict(labels), "value": value})
+            gauges: Dict[str, list] = {}
+            for key, value in sorted(self._gauge_values.items()):
+                gauges.setdefault(key[0], []).append({
+                    "labels": dict(key[1]), "value": value, "max": self._gauge_max[key],
+                })
+            histograms: Dict[str, list] = {}
+            for (name, labels), h in sorted(self._histograms.items()):
+                histograms.setdefault(name, []).append({
+                    "labels": dict(labels),
+                    "count": h.count,
+                    "sum": h.sum,
+                    "mean": h.sum / h.count if h.count else None,
+                    "p50": h.quantile(0.5),
+                    "p90": h.quantile(0.9),
+                    "p99": h.quantile(0.99),
+                    "buckets": dict(h.cumulative()),
+                })
+        return {
+            "started": self.started,
+            "elapsed": time.time() - self.started,
+            "counters": counters,
+            "gauges": gauges,
+            "histograms": histograms,
+        }
+
+    def write_report(self, path: str) -> None:
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(self.report(), f, indent=2)
+
+    def prometheus(self) -> str:
+        """Render every metric in the Prometheus text exposition format."""
+        self.sample()
+        lines = []
+        with self._lock:
+            typed = set()
+            for (name, labels), value in sorted(self._counters.items()):
+                if name not in typed:
+                    lines.append(f"# TYPE {name} counter")
+                    typed.add(name)
+                lines.append(f"{name}{_format_labels(labels)} {value}")
+            for (name, labels), value in sorted(self._gauge_values.items()):
+                if name not in typed:
+                    lines.append(f"# TYPE {name} gauge")
+                    typed.add(name)
+                lines.append(f"{name}{_format_labels(labels)} {value}")
+            for (name, labels), h in sorted(self._histograms.items()):
+                if name not in typed:
+                    lines.append(f"# TYPE {name} histogram")
+                    typed.add(name)
+                for bound, count in h.cumulative():
+                    lines.append(f"{name}_bucket{_format_labels(labels, (('le', bound),))} {count}")
+                lines.append(f"{name}_sum{_format_labels(labels)} {h.sum}")
+                lines.append(f"{name}_count{_format_labels(labels)} {h.count}")
+        return "\n".join(lines) + "\n"
+
+    def serve(self, port: int, host: str = "127.0.0.1") -> None:
+        """Serve the metrics as Prometheus text on ``http://host:port/metrics``."""
+        from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+        metrics = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, format, *args) -> None:
+                pass
+
+            def do_GET(self) -> None:
+                if self.path != "/metrics":
+                    self.send_error(404)
+                    return
+                body = metrics.prometheus().encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+        self._server = ThreadingHTTPServer((host, port), Handler)
+        self._server.daemon_threads = True
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+
+    def close(self) -> None:
+        self._stop.set()
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
@@ -0,0 +1,105 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Extraction of data from renren pages.
+
+Selectors are compiled once at import. Pages are fed to a pull parser in
+chunks and parsing stops as soon as the wanted element is complete, so the
+rest of the page (comments, sidebars, footers) is never built into a tree.
+"""
+import json
+import re
+from typing import Callable, Dict, Iterable, List, Optional, Tuple, Union
+
+import lxml.html
+from lxml import etree
+
+JSONType = Dict[str, Union[str, int]]
+Source = Union[str, bytes, Iterable[Union[str, bytes]]]
+
+CHUNK_SIZE = 16 * 1024
+
+ALBUM_COUNT = re.compile(r"""['"]albumCount['"]\s*:\s*(\d+)""")
+ARTICLE_ITEMS = etree.XPath('//div[@class="list"]/div[not(@class)]')
+ITEM_TITLE = etree.XPath('string(a)')
+ITEM_URL = etree.XPath('string(a/@href)')
+ITEM_TIME = etree.XPath('string(p)')
+NEXT_PAGE = etree.XPath('//a[@title="下一页"]/@href')
+
+_decoder = json.JSONDecoder()
+
+
+def _chunks(source: Source) -> Iterable[Union[str, bytes]]:
+    if isinstance(source, (str, bytes)):
+        for start in range(0, len(source), CHUNK_SIZE):
+            yield source[start:start + CHUNK_SIZE]
+    else:
+        yield from source
+
+
+def find_element(
+    source: Source, tag: str, match: Callable[[etree._Element], bool]
+) -> Optional[etree._Element]:
+    """Return the first complete ``tag`` element accepted by ``match``,
+    reading no more of ``source`` than needed.
+    """
+    parser = etree.HTMLPullParser(events=("end",), tag=tag)
+    for chunk in _chunks(source):
+        parser.feed(chunk)
+        for _, element in parser.read_events():
+            if match(element):
+                return element
+    parser.close()
+    for _, element in parser.read_events():
+        if match(element):
+            return element
+    return None
+
+
+def inner_html(element: etree._Element) -> str:
+    return (element.text or "") + "".join(
+        etree.tostring(child, encoding="unicode", method="html") for child in element
+    )
+
+
+def extract_article_body(source: Source) -> str:
+    """Return the HTML inside ``<div class="con">`` of an article page."""
+    element = find_element(source, "div", lambda e: e.get("class") == "con")
+    if element is None:
+        raise ValueError("Article body not found")
+    return inner_html(element).strip()
+
+
+def parse_album_list_page(source: Source) -> Tuple[List[JSONType], Optional[int]]:
+    """Return the albums embedded in an album list page script, empty ones
+    included, and the total number of albums if the page states it.
+    """
+    element = find_element(source, "script", lambda e: "'albumList'" in (e.text or ""))
+    if element is None:
+        raise ValueError("Album list not found")
+    script = element.text
+    start = script.index("[", script.index("'albumList'"))
+    # Decoding from the opening bracket consumes exactly one JSON value,
+    # however deeply it nests.
+    albumlist, end = _decoder.raw_decode(script, start)
+    count = ALBUM_COUNT.search(script, end)
+    return albumlist, int(count.group(1)) if count else None
+
+
+def extract_album_list(source: Source) -> List[JSONType]:
+    """Return the non-empty albums embedded in the album list page script."""
+    return [item for item in parse_album_list_page(source)[0] if item.get("photoCount")]
+
+
+def parse_article_page(text: str) -> Tuple[List[JSONType], Optional[str]]:
+    """Return the articles listed on one blog page and the next page url."""
+    tree = lxml.html.fromstring(text)
+    results = [
+        {
+            'title': ITEM_TITLE(element).strip(),
+            'url': ITEM_URL(element).strip(),
+            'createTime': ITEM_TIME(element).strip(),
+        }
+        for element in ARTICLE_ITEMS(tree)
+    ]
+    next_url = NEXT_PAGE(tree)
+    return results, next_url[0].strip() if next_url else None
@@ -0,0 +1,78 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Progress bookkeeping shared by the GUI and the command line."""
+import threading
+import time
+from typing import Dict, Optional
+
+
+def format_size(size: float) -> str:
+    for unit in ("B", "KB", "MB"):
+        if size < 1024:
+            return f"{size:.1f}{unit}"
+        size /= 1024
+    return f"{size:.1f}GB"
+
+
+def format_duration(seconds: float) -> str:
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return f"{hours:d}:{minutes:02d}:{seconds:02d}"
+
+
+class ProgressBar:
+    def __init__(self, total: int, desc: str, lock: threading.Lock) -> None:
+        self.current = 0
+        self.total = total
+        self.desc = desc
+        self._lock = lock
+
+    def update(self, number: int = 1) -> None:
+        with self._lock:
+            self.current += number
+
+
+class Progress:
+    """Collects the progress bars the spider opens from its crawl threads and
+    sums them up into snapshots.
+    """
+
+    def __init__(self, spider) -> None:
+        self.spider = spider
+        self.bars = []
+        self.started = time.monotonic()
+        self._lock = threading.Lock()
+
+    def progressbar(self, total: int, desc: str) -> ProgressBar:
+        bar = ProgressBar(total, desc, self._lock)
+        with self._lock:
+            self.bars.append(bar)
+        return bar
+
+    def snapshot(self) -> Dict[str, object]:
+        with self._lock:
+            active = [bar.desc for bar in self.bars if bar.current < bar.total]
+            current = sum(bar.current for bar in self.bars)
+            total = sum(bar.total for bar in self.bars)
+        elapsed = max(time.monotonic() - self.started, 1e-6)
+        rate = current / elapsed
+        return {
+            "active": active,
+            "current": current,
+            "total": total,
+            "elapsed": elapsed,
+            "items_per_second": rate,
+            "bytes_per_second": self.spider.bytes_transferred / elapsed,
+            "eta": (total - current) / rate if rate else None,
+        }
+
+
+def describe(snapshot: Dict[str, object]) -> str:
+    eta: Optional[float] = snapshot["eta"]
+    return "{}/{} items, {:.1f} items/s, {}/s, ETA {}".format(
+        snapshot["current"],
+        snapshot["total"],
+        snapshot["items_per_second"],
+        format_size(snapshot["bytes_per_second"]),
+        format_duration(eta) if eta is not None else "--",
+    )
@@ -1,6 +1,57 @@
+import multiprocessing
 import sys
-import spider
-from spider_ui import Ui_Dialog, QtWidgets, QtGui
+import time
+from progress import Progress, format_duration, format_size
+from spider_ui import Ui_Dialog, QtCore, QtWidgets, QtGui
+
+
+class ProgressTracker(QtCore.QObject):
+    """Collects progress from the crawl threads and publishes a combined
+    snapshot at a fixed rate, so the UI is never updated per item.
+    """
+
+    FPS = 10
+    progress = QtCore.Signal(object)
+
+    def __init__(self, spider_, parent=None):
+        super().__init__(parent)
+        self.counter = Progress(spider_)
+        self._timer = QtCore.QTimer(self)
+        self._timer.setInterval(1000 // self.FPS)
+        self._timer.timeout.connect(self.publish)
+
+    def start(self):
+        self.counter.started = time.monotonic()
+        self._timer.start()
+
+    def stop(self):
+        self._timer.stop()
+        self.publish()
+
+    def progressbar(self, total: int, desc: str):
+        return self.counter.progressbar(total, desc)
+
+    def publish(self):
+        self.progress.emit(self.counter.snapshot())
+
+
+class DumpWorker(QtCore.QThread):
+    failed = QtCore.Signal(str)
+
+    def __init__(self, spider_, tracker, parent=None):
+        super().__init__(parent)
+        self.spider = spider_
+        self.tracker = tracker
+
+    def run(self):
+        import spider
+
+        try:
+            self.spider.main(self.tracker)
+        except spider.Cancelled:
+            pass
+        except Exception as e:
+            self.failed.emit(str(e))
 
 
 class SpiderDialog(QtWidgets.QDialog):
@@ -8,18 +59,39 @@ class SpiderDialog(QtWidgets.QDialog):
         super().__init__(parent)
         self.ui = Ui_Dialog()
         self.ui.setupUi(self)
-        self.spider = spider.RenrenSpider()
+        self.spider = None
+        self.worker = None
+        self.tracker = None
+        self.failed = False
+        # Nothing can log in or dump before load_spider has run.
+        self.ui.loginBtn.setEnabled(False)
+        self.ui.startBtn.setEnabled(False)
+        self.ui.pauseBtn.setEnabled(False)
+        self.ui.cancelBtn.setEnabled(False)
         self.init_signals()
+
+    def load_spider(self):
+        # The crawler and its dependencies are imported once the window is
+        # already on screen.
+        import spider
+
+        self.spider = spider.RenrenSpider()
         if self.spider.is_login():
             self.ui.loginFrame.hide()
             self.ui.mainFrame.show()
+        self.ui.loginBtn.setEnabled(True)
+        self.ui.startBtn.setEnabled(True)
 
     def init_signals(self):
         self.ui.loginBtn.clicked.connect(self.on_login)
         self.ui.startBtn.clicked.connect(self.on_start)
         self.ui.browserBtn.clicked.connect(self.on_browse_dir)
+        self.ui.pauseBtn.toggled.connect(self.on_pause)
+        self.ui.cancelBtn.clicked.connect(self.on_cancel)
 
     def on_login(self):
+        import spider
+
         email = self.ui.emailInput.text()
         password = self.ui.passwordInput.text()
         remember = self.ui.rememberCkb.isChecked()
@@ -48,8 +120,68 @@ class SpiderDialog(QtWidgets.QDialog):
             output_dir=self.ui.outputPathInput.text()
         )
         self.ui.progressFrame.show()
-        self.spider.main(self)
-        self.ui.label.setText("备份完成！")
+        self.ui.startBtn.setEnabled(False)
+        self.ui.pauseBtn.setChecked(False)
+        self.ui.pauseBtn.setEnabled(True)
+        self.ui.cancelBtn.setEnabled(True)
+        self.ui.progressBar.reset()
+        self.failed = False
+        self.tracker = ProgressTracker(self.spider, self)
+        self.tracker.progress.connect(self.on_progress)
+        self.worker = DumpWorker(self.spider, self.tracker, self)
+        self.worker.failed.connect(self.on_failed)
+        self.worker.finished.connect(self.on_finished)
+        self.tracker.start()
+        self.worker.start()
+
+    def on_progress(self, snapshot):
+        if snapshot["active"]:
+            self.ui.label.setText("\n".join(snapshot["active"][:2]))
+        if snapshot["total"]:
+            self.ui.progressBar.setValue(int(snapshot["current"] / snapshot["total"] * 100))
+        eta = snapshot["eta"]
+        self.ui.statsLabel.setText("{}/{} 项, {:.1f} 项/秒, {}/秒, 剩余 {}".format(
+            snapshot["current"],
+            snapshot["total"],
+            snapshot["items_per_second"],
+            format_size(snapshot["bytes_per_second"]),
+            format_duration(eta) if eta is not None else "--",
+        ))
+
+    def on_pause(self, paused):
+        if paused:
+            self.spider.pause()
+            self.ui.pauseBtn.setText("继续")
+        else:
+            self.spider.resume()
+            self.ui.pauseBtn.setText("暂停")
+
+    def on_cancel(self):
+        self.ui.cancelBtn.setEnabled(False)
+        self.ui.pauseBtn.setEnabled(False)
+        self.spider.cancel()
+
+    def on_failed(self, message):
+        self.failed = True
+        self.ui.label.setText("备份失败")
+        error = QtWidgets.QErrorMessage(self)
+        error.showMessage(message)
+
+    def on_finished(self):
+        self.tracker.stop()
+        self.ui.startBtn.setEnabled(True)
+        self.ui.pauseBtn.setEnabled(False)
+        self.ui.cancelBtn.setEnabled(False)
+        if self.spider.cancelled:
+            self.ui.label.setText("备份已取消")
+        elif not self.failed:
+            self.ui.label.setText("备份完成！")
+
+    def closeEvent(self, event):
+        if self.worker is not None and self.worker.isRunning():
+            self.spider.cancel()
+            self.worker.wait()
+        super().closeEvent(event)
 
     def on_browse_dir(self):
         file_dialog = QtWidgets.QFileDialog()
@@ -58,28 +190,17 @@ class SpiderDialog(QtWidgets.QDialog):
         if file_dialog.exec_():
             self.ui.outputPathInput.setText(file_dialog.selectedFiles()[0])
 
-    def progressbar(self, total: int, desc: str):
-        ui = self.ui
-
-        class ProgressBar(object):
-            def __init__(self):
-                self.current = 0.0
-                ui.label.setText(desc)
-                ui.progressBar.reset()
-
-            def update(self, number: int = 1):
-                self.current += number
-                ui.progressBar.setValue(int(self.current / total * 100))
-
-        return ProgressBar()
-
 
 def main():
     app = QtWidgets.QApplication(sys.argv)
     dialog = SpiderDialog()
     dialog.show()
+    QtCore.QTimer.singleShot(0, dialog.load_spider)
     sys.exit(app.exec_())
 
 
 if __name__ == "__main__":
+    # Articles are converted in worker processes, which frozen builds must
+    # be able to start.
+    multiprocessing.freeze_support()
     main()
@@ -0,0 +1,206 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import itertools
+import math
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from typing import Callable, Optional
+
+# Lower runs first. Text work is tiny compared to photos, so it is never kept
+# waiting behind a long queue of downloads.
+PRIORITY_TEXT = 0
+PRIORITY_LISTING = 1
+PRIORITY_PHOTO = 2
+
+
+class TokenBucket:
+    """Bandwidth budget shared by every download, in bytes per second."""
+
+    def __init__(self, rate: float, burst: Optional[float] = None) -> None:
+        self.rate = rate
+        self.capacity = burst or rate
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def reserve(self, nbytes: int) -> float:
+        """Take ``nbytes`` from the budget, return how long the caller must
+        wait before using them.
+        """
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(
+                self.capacity, self._tokens + (now - self._updated) * self.rate
+            )
+            self._updated = now
+            self._tokens -= nbytes
+            if self._tokens >= 0:
+                return 0.0
+            return -self._tokens / self.rate
+
+
+class Scheduler:
+    """A fixed pool of worker threads consuming one priority queue.
+
+    All dump categories submit their requests here, so they share a single
+    concurrency limit, adaptive request limiter and bandwidth budget.
+    """
+
+    def __init__(self, workers: int, bandwidth: Optional[float] = None) -> None:
+        self.bucket = TokenBucket(bandwidth) if bandwidth else None
+        self.limiter = AdaptiveLimiter(workers)
+        self._queue = queue.PriorityQueue()
+        self._counter = itertools.count()
+        self._threads = [
+            threading.Thread(target=self._work, daemon=True) for _ in range(workers)
+        ]
+        for thread in self._threads:
+            thread.start()
+
+    def _work(self) -> None:
+        while True:
+            _, _, future, fn, args, kwargs = self._queue.get()
+            if future is None:
+                return
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                result = fn(*args, **kwargs)
+            except BaseException as e:
+                future.set_exception(e)
+            else:
+                future.set_result(result)
+
+    def submit(self, fn: Callable, *args, priority: int = PRIORITY_TEXT, **kwargs) -> Future:
+        future = Future()
+        self._queue.put((priority, next(self._counter), future, fn, args, kwargs))
+        return future
+
+    @property
+    def queue_depth(self) -> int:
+        return self._queue.qsize()
+
+    def throttle(self, nbytes: int) -> None:
+        if self.bucket is not None:
+            delay = self.bucket.reserve(nbytes)
+            if delay:
+                time.sleep(delay)
+
+    def shutdown(self, cancel_pending: bool = False) -> None:
+        if cancel_pending:
+            while True:
+                try:
+                    _, _, future, *_ = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                if future is not None:
+                    future.cancel()
+        for _ in self._threads:
+            self._queue.put((math.inf, next(self._counter), None, None, (), {}))
+        for thread in self._threads:
+            thread.join()
+
+    def __enter__(self) -> "Scheduler":
+        return self
+
+    def __exit__(self, exc_type, exc, tb) -> None:
+        self.shutdown(cancel_pending=exc_type is not None)
+
+
+class AIMDWindow:
+    """Additive-increase/multiplicative-decrease estimate of how many requests
+    can be in flight before the server starts failing or throttling them.
+    """
+
+    COOLDOWN = 1.0
+
+    def __init__(self, maximum: int, minimum: int = 1) -> None:
+        self.maximum = maximum
+        self.minimum = minimum
+        self.limit = float(maximum)
+        self._last_decrease = 0.0
+        self._lock = threading.Lock()
+
+    def on_success(self) -> None:
+        with self._lock:
+            # Grows by about one slot per window of successful requests.
+            self.limit = min(self.maximum, self.limit + 1 / self.limit)
+
+    def on_failure(self) -> None:
+        with self._lock:
+            now = time.monotonic()
+            # A burst of errors from the same overload halves the window once.
+            if now - self._last_decrease < self.COOLDOWN:
+                return
+            self._last_decrease = now
+            self.limit = max(self.minimum, self.limit / 2)
+
+    @property
+    def size(self) -> int:
+        return int(self.limit)
+
+
+class AdaptiveLimiter:
+    """Caps the requests in flight across threads to the current AIMD window."""
+
+    def __init__(self, maximum: int, minimum: int = 1) -> None:
+        self.window = AIMDWindow(maximum, minimum)
+        self.in_flight = 0
+        self.waiting = 0
+        self._cond = threading.Condition()
+
+    def __enter__(self) -> "AdaptiveLimiter":
+        with self._cond:
+            self.waiting += 1
+            while self.in_flight >= self.window.size:
+                self._cond.wait()
+            self.waiting -= 1
+            self.in_flight += 1
+        return self
+
+    def __exit__(self, exc_type, exc, tb) -> None:
+        with self._cond:
+            self.in_flight -= 1
+            self._cond.notify_all()
+
+    def on_success(self) -> None:
+        self.window.on_success()
+
+    def on_failure(self) -> None:
+        self.window.on_failure()
+
+
+class AsyncAdaptiveLimiter:
+    """The coroutine flavour of AdaptiveLimiter, for use on one event loop."""
+
+    def __init__(self, maximum: int, minimum: int = 1) -> None:
+        self.window = AIMDWindow(maximum, minimum)
+        self.in_flight = 0
+        self.waiting = 0
+        # Only the async engine needs asyncio, which is slow to import.
+        import asyncio
+
+        self._cond = asyncio.Condition()
+
+    async def __aenter__(self) -> "AsyncAdaptiveLimiter":
+        self.waiting += 1
+        try:
+            async with self._cond:
+                await self._cond.wait_for(lambda: self.in_flight < self.window.size)
+                self.in_flight += 1
+        finally:
+            self.waiting -= 1
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb) -> None:
+        async with self._cond:
+            self.in_flight -= 1
+            self._cond.notify_all()
+
+    def on_success(self) -> None:
+        self.window.on_success()
+
+    def on_failure(self) -> None:
+        self.window.on_failure()
@@ -1,21 +1,43 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
-import argparse
+import contextlib
 import datetime
+import hashlib
 import html
+import importlib
 import json
 import os
 import pickle
 import random
-import re
-import lxml.html
-from typing import Callable, Dict, List, Union
-
-import html2text
-from requests import Session
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from urllib.parse import urlsplit
+from typing import Callable, Dict, Iterator, List, Optional, Set, Tuple, TypeVar, Union
+
+from requests import Response, Session, exceptions
+
+from blobstore import IncompleteDownload, PartialDownload
+from cache import ResponseCache
+from converter import Converter
+from metrics import Metrics
+from scheduler import PRIORITY_LISTING, PRIORITY_PHOTO, Scheduler
+from state import CrawlState
+from transport import TRANSPORTS, Http2Adapter, InstrumentedAdapter
+from writers import OUTPUT_FORMATS, create_writer
 
 JSONType = Dict[str, Union[str, int]]
 SimpleCallback = Callable[[], None]
+T = TypeVar("T")
+
+RETRY_EXCEPTIONS = (
+    exceptions.ConnectionError,
+    exceptions.Timeout,
+    exceptions.ChunkedEncodingError,
+    exceptions.HTTPError,
+    IncompleteDownload,
+)
 
 
 class LoginFailed(Exception):
@@ -26,6 +48,31 @@ class iCodeRequired(Exception):
     pass
 
 
+class Cancelled(Exception):
+    pass
+
+
+def default_work_dir(output_dir: str, user_id) -> str:
+    """Local directory for the state of an archive dump, one per archive."""
+    base = os.getenv("LOCALAPPDATA") or os.getenv("XDG_STATE_HOME") \
+        or os.path.expanduser(os.path.join("~", ".local", "state"))
+    key = hashlib.sha1(os.path.abspath(output_dir).encode("utf-8")).hexdigest()[:12]
+    return os.path.join(base, "renren-dumps", f"{user_id}-{key}")
+
+
+class NotCached(Exception):
+    """An offline run needed a response that is not in the cache."""
+
+
+ARTICLE_TEMPLATE = """\
+{title}
+=======
+日期: {datetime}
+
+{content}
+"""
+
+
 def encrypt_string(enc, mo, s):
     b = 0
     pos = 0
@@ -38,21 +85,133 @@ def encrypt_string(enc, mo, s):
     return f'{crypt:x}'
 
 
+def is_retryable(status: Optional[int]) -> bool:
+    """Whether a response status, or a transport error when it is None,
+    is worth retrying.
+    """
+    return status is None or status == 429 or status >= 500
+
+
+def album_dirname(album: JSONType) -> str:
+    return html.unescape(album["albumName"]).strip("./")
+
+
+def largest_first(albums: List[JSONType]) -> List[JSONType]:
+    """Drop empty and repeated albums, and order the rest by photo count so
+    the longest downloads start first and finish the dump sooner.
+    """
+    unique = {album["albumId"]: album for album in albums if album.get("photoCount")}
+    return sorted(unique.values(), key=lambda album: int(album["photoCount"]), reverse=True)
+
+
+def article_name(article: JSONType) -> str:
+    return f"articles/{article['title']}.md"
+
+
+def photo_name(album_name: str, url: str) -> str:
+    return f"albums/{album_name}/{url.rsplit('/', 1)[-1]}"
+
+
+def render_article(article: JSONType, text: str) -> str:
+    # Rendering runs in converter processes, the parent never needs these.
+    import html2text
+    from parsing import extract_article_body
+
+    content = extract_article_body(text)
+    return ARTICLE_TEMPLATE.format(
+        title=article["title"],
+        datetime=article["createTime"],
+        content=html2text.html2text(content),
+    )
+
+
+def render_status(item: JSONType) -> str:
+    import html2text
+
+    if item.get("location"):
+        heading = f"{item['dtime']} 在 {item['location']}"
+    else:
+        heading = item['dtime']
+    content = html2text.html2text(item['content'])
+    return f"### {heading}\n\n{content}\n\n"
+
+
+def render_status_page(items: List[JSONType]) -> str:
+    return "".join(render_status(item) for item in items)
+
+
 class RenrenSpider:
     ENCRYPT_KEY_URL = "http://login.renren.com/ajax/getEncryptKey"
     LOGIN_URL = "http://www.renren.com/ajaxLogin/login?1=1&uniqueTimestamp={ts}"
     LOGIN_3G_URL = "http://3g.renren.com/login.do?autoLogin=true&"
     ICODE_URL = "http://icode.renren.com/getcode.do?t=web_login&rnd={rnd}"
+    ALBUM_LIST_URL = "http://photo.renren.com/photo/{user_id}/albumlist/v7?offset={offset}&limit={limit}&showAll=1"
+    ALBUM_PAGE_URL = "http://photo.renren.com/photo/{user_id}/album-{album_id}/bypage/ajax/v7?pageSize=100&page={page}"
+    ALBUM_LIST_LIMIT = 40
+    ARTICLE_LIST_URL = "http://3g.renren.com/blog/wmyblog.do?id={user_id}"
+    STATUS_URL = "http://status.renren.com/GetSomeomeDoingList.do?userId={user_id}&curpage={page}"
     MAX_RETRY = 3
+    BACKOFF_BASE = 1.0
+    BACKOFF_MAX = 60.0
+    CONNECT_TIMEOUT = 10
+    READ_TIMEOUT = 60
+    DEFAULT_CONCURRENCY = 8
+    # Hosts whose connection pools are kept. Photos come from several CDN
+    # hosts, and a pool pushed out by another host closes its connections.
+    POOL_HOSTS = 32
+    CHUNK_SIZE = 64 * 1024
+    # Photos at least this large are downloaded to a part file that later
+    # attempts resume with Range requests.
+    RESUME_MIN_SIZE = 1024 * 1024
+    PARTIAL_DIR = ".partial"
+    STATUS_PAGE_SIZE = 20
+    STATUS_WINDOW = 16
+    ALBUMS_IN_FLIGHT = 4
+    CATEGORIES = ("albums", "articles", "status")
+    SESSION_FILE = ".session"
 
     def __init__(self) -> None:
         self.ui = None
         self.user_id = None
         self.output_dir = None
+        self.work_dir = None
+        # Where the state, response cache and partial downloads of a run are.
+        self.data_dir = None
+        self.concurrency = self.DEFAULT_CONCURRENCY
+        self.refresh = False
+        self.categories = self.CATEGORIES
+        self.bandwidth = None
+        self.output_format = "dir"
+        self.state = None
+        self.output = None
+        self.cache = None
+        self.cache_size = ResponseCache.DEFAULT_MAX_SIZE
+        self.offline = False
+        self.incremental = False
+        self.transport = "http1"
+        self.scheduler = None
+        self.converter = None
+        # Worker processes converting HTML, defaults to one per CPU.
+        self.convert_workers = None
+        self.limiter = None
+        self.metrics = Metrics()
+        self.metrics_file = None
+        self.metrics_port = None
+        self.bytes_transferred = 0
+        # Photo downloads in flight by URL, so albums sharing a photo wait for
+        # the same download.
+        self._downloads: Dict[str, Future] = {}
+        self._downloads_lock = threading.Lock()
+        self._stats_lock = threading.Lock()
+        self._cancelled = threading.Event()
+        self._running = threading.Event()
+        self._running.set()
         self.s = Session()
+        self._mount_adapters()
         self.s.headers = {
             "User-Agent": "Mozilla/5.0 (Windows NT 10.0; WOW64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/72.0.3626.121 Safari/537.36"
         }
+        self.session_file = self.SESSION_FILE
         self.re = None
         self.rn = None
         self.rk = None
@@ -96,13 +255,214 @@ class RenrenSpider:
         if not self.user_id:
             self.user_id = self.s.cookies["id"]
         if keep:
-            with open(".session", "wb") as f:
+            with open(self.session_file, "wb") as f:
                 pickle.dump(self.s.cookies, f)
 
-    def set_params(self, *, user_id=None, output_dir=None) -> None:
+    def _mount_adapters(self) -> None:
+        for adapter in set(self.s.adapters.values()):
+            adapter.close()
+        # Every worker thread may hold a connection at the same time, so the
+        # per-host pool must be at least as large as the worker pool.
+        adapter_class = Http2Adapter if self.transport == "http2" else InstrumentedAdapter
+        adapter = adapter_class(
+            self.metrics, pool_connections=self.POOL_HOSTS, pool_maxsize=self.concurrency
+        )
+        self.s.mount("http://", adapter)
+        self.s.mount("https://", adapter)
+
+    def set_params(
+        self, *, user_id=None, output_dir=None, concurrency=None, refresh=False,
+        categories=None, bandwidth=None, output_format="dir",
+        metrics_file=None, metrics_port=None, convert_workers=None,
+        cache_size=None, offline=False, incremental=False, transport=None,
+        work_dir=None,
+    ) -> None:
         if user_id:
             self.user_id = user_id
         self.output_dir = output_dir
+        # State, cache and partial downloads of archive dumps, which keep
+        # nothing but the archive in the output directory. Directory dumps
+        # keep them in the output unless this is set.
+        self.work_dir = work_dir
+        # HTTP client of the session, http2 needs httpx.
+        if transport and transport not in TRANSPORTS:
+            raise ValueError(f"Unknown transport: {transport}")
+        if concurrency or transport:
+            self.concurrency = max(1, int(concurrency or self.concurrency))
+            self.transport = transport or self.transport
+            self._mount_adapters()
+        # Re-list albums, articles and status even if a previous run finished
+        # them. Items already downloaded are still skipped.
+        self.refresh = refresh
+        if categories:
+            unknown = set(categories) - set(self.CATEGORIES)
+            if unknown:
+                raise ValueError(f"Unknown categories: {', '.join(sorted(unknown))}")
+            self.categories = tuple(c for c in self.CATEGORIES if c in categories)
+        # Overall download budget in bytes per second, None for unlimited.
+        self.bandwidth = bandwidth
+        if output_format not in OUTPUT_FORMATS:
+            raise ValueError(f"Unknown output format: {output_format}")
+        self.output_format = output_format
+        # Where to write the JSON metrics report of each run.
+        self.metrics_file = metrics_file
+        # Local port serving live metrics in the Prometheus text format.
+        self.metrics_port = metrics_port
+        if convert_workers:
+            self.convert_workers = max(1, int(convert_workers))
+        # Bytes of listing and page responses kept on disk, 0 disables it.
+        if cache_size is not None:
+            self.cache_size = int(cache_size)
+        # Render articles and status again from cached responses only, photos
+        # are left as they are.
+        if offline and output_format != "dir":
+            raise ValueError("Offline runs rewrite files, which needs the dir format")
+        self.offline = offline
+        # Only fetch the articles and status posted since the last run, and
+        # add them to the existing output.
+        if incremental and output_format != "dir":
+            raise ValueError("Incremental runs add to status.md, which needs the dir format")
+        self.incremental = incremental
+
+    def pause(self) -> None:
+        self._running.clear()
+
+    def resume(self) -> None:
+        self._running.set()
+
+    def cancel(self) -> None:
+        self._cancelled.set()
+        self._running.set()
+
+    @property
+    def cancelled(self) -> bool:
+        return self._cancelled.is_set()
+
+    def checkpoint(self) -> None:
+        """Block while the dump is paused and abort it once cancelled."""
+        self._running.wait()
+        if self._cancelled.is_set():
+            raise Cancelled()
+
+    def on_chunk(self, nbytes: int) -> None:
+        self.scheduler.throttle(nbytes)
+        self.checkpoint()
+        with self._stats_lock:
+            self.bytes_transferred += nbytes
+
+    def retry_delay(self, attempt: int, retry_after: Optional[str] = None) -> float:
+        """Exponential backoff with full jitter, honouring Retry-After if sent."""
+        delay = random.uniform(0, min(self.BACKOFF_MAX, self.BACKOFF_BASE * 2 ** attempt))
+        if retry_after and retry_after.isdigit():
+            delay = max(delay, float(retry_after))
+        return delay
+
+    def retrying(
+        self, fn: Callable[..., T], *args,
+        progress: Optional[Callable[[], int]] = None, **kwargs
+    ) -> T:
+        """Call ``fn`` until it succeeds or MAX_RETRY retries are used up.
+
+        Only transport errors, 5xx and 429 responses are retried. Every call
+        is admitted by the scheduler's adaptive limiter, which shrinks while
+        such failures keep coming and grows back as requests succeed.
+        ``progress`` tells how far a resumable download got, a failed attempt
+        that moved it forward starts the count of retries over.
+        """
+        limiter = self.limiter
+        attempt = 0
+        while True:
+            self.checkpoint()
+            mark = progress() if progress else 0
+            try:
+                with limiter or contextlib.nullcontext():
+                    result = fn(*args, **kwargs)
+            except RETRY_EXCEPTIONS as e:
+                response = e.response if isinstance(e, exceptions.HTTPError) else None
+                status = response.status_code if response is not None else None
+                if progress and progress() > mark:
+                    attempt = 0
+                if attempt >= self.MAX_RETRY or not is_retryable(status):
+                    raise
+                if limiter is not None:
+                    limiter.on_failure()
+                self.metrics.inc("http_retries_total", reason=status or type(e).__name__)
+                retry_after = response.headers.get("Retry-After") if response is not None else None
+                self._cancelled.wait(self.retry_delay(attempt, retry_after))
+                attempt += 1
+            else:
+                if limiter is not None:
+                    limiter.on_success()
+                return result
+
+    def _get(self, url: str, **kwargs) -> Response:
+        kwargs.setdefault("timeout", (self.CONNECT_TIMEOUT, self.READ_TIMEOUT))
+        host = urlsplit(url).hostname
+        started = time.perf_counter()
+        try:
+            resp = self.s.get(url, **kwargs)
+        except exceptions.RequestException as e:
+            self.metrics.record_request(host, type(e).__name__, time.perf_counter() - started)
+            raise
+        # Streamed bodies are read later, they are counted by the caller.
+        self.metrics.record_request(
+            host, resp.status_code, time.perf_counter() - started,
+            0 if kwargs.get("stream") else len(resp.content),
+        )
+        try:
+            resp.raise_for_status()
+        except exceptions.HTTPError:
+            resp.close()
+            raise
+        return resp
+
+    def get(self, url: str, **kwargs) -> Response:
+        return self.retrying(self._get, url, **kwargs)
+
+    def fetch_text(self, url: str) -> str:
+        """Return the body of a listing or page, through the response cache."""
+        if self.offline:
+            text = self.cache.get(url)
+            if text is None:
+                self.metrics.inc("cache_misses_total")
+                raise NotCached(url)
+            return text
+        text = self.get(url).text
+        if self.cache is not None:
+            self.cache.put(url, text)
+        return text
+
+    def open_output(self) -> None:
+        if not os.path.isdir(self.output_dir):
+            os.makedirs(self.output_dir)
+        self.data_dir = self.work_dir or (
+            self.output_dir if self.output_format == "dir"
+            else default_work_dir(self.output_dir, self.user_id)
+        )
+        os.makedirs(self.data_dir, exist_ok=True)
+        self.state = CrawlState(os.path.join(self.data_dir, CrawlState.FILENAME))
+        if self.cache_size or self.offline:
+            self.cache = ResponseCache(
+                os.path.join(self.data_dir, ResponseCache.FILENAME), self.cache_size
+            )
+        if self.refresh and not self.offline:
+            self.state.reset_feed("articles")
+            self.state.reset_feed("status")
+        self.output = create_writer(
+            self.output_dir, self.output_format, name=f"renren-{self.user_id}",
+            tmp_dir=self.data_dir,
+        )
+
+    def close_output(self) -> None:
+        if self.output is not None:
+            self.output.close()
+            self.output = None
+        if self.cache is not None:
+            self.cache.close()
+            self.cache = None
+        if self.state is not None:
+            self.state.close()
+            self.state = None
 
     def get_icode_image(self) -> bytes:
         resp = self.s.get(self.ICODE_URL.format(rnd=random.random()))
@@ -110,9 +470,9 @@ class RenrenSpider:
 
     def is_login(self) -> bool:
         """login and get cookies."""
-        if not os.path.isfile(".session"):
+        if not os.path.isfile(self.session_file):
             return False
-        with open(".session", "rb") as f:
+        with open(self.session_file, "rb") as f:
             self.s.cookies = pickle.load(f)
         self.s.cookies.clear_expired_cookies()
         if "id" not in self.s.cookies:
@@ -121,164 +481,517 @@ class RenrenSpider:
             self.user_id = self.s.cookies["id"]
         return True
 
-    def parse_album_list(self) -> List[JSONType]:
-        collections_url = f"http://photo.renren.com/photo/{self.user_id}/albumlist/v7?offset=0&limit=40&showAll=1"
-        resp = self.s.get(collections_url)
-        albumlist = json.loads(
-            re.findall(r"'albumList':\s*(\[[\s\S]*?\])", resp.text)[0]
+    def fetch_album_list_page(self, offset: int) -> Tuple[List[JSONType], Optional[int]]:
+        from parsing import parse_album_list_page
+
+        url = self.ALBUM_LIST_URL.format(
+            user_id=self.user_id, offset=offset, limit=self.ALBUM_LIST_LIMIT
         )
-        return [item for item in albumlist if item.get("photoCount")]
+        with self.metrics.timer("stage_seconds", stage="album_list"):
+            return parse_album_list_page(self.fetch_text(url))
 
-    def download_album(self, album: JSONType) -> None:
-        album_name = html.unescape(album["albumName"]).strip("./")
-        photo_list = []
-        album_url = f"http://photo.renren.com/photo/{self.user_id}/album-{album['albumId']}/bypage/ajax/v7?pageSize=100"
-        for i in range(int(album["photoCount"] // 100) + 1):
-            resp = self.s.get(f"{album_url}&page={i+1}")
-            resp.raise_for_status()
-            photo_list.extend(resp.json()["photoList"])
+    def parse_album_list(self) -> List[JSONType]:
+        albums, total = self.fetch_album_list_page(0)
+        if total is None:
+            # Without a count the pages are walked until a short one.
+            page = albums
+            while len(page) == self.ALBUM_LIST_LIMIT:
+                page, _ = self.fetch_album_list_page(len(albums))
+                albums.extend(page)
+        else:
+            pages = [
+                self.scheduler.submit(
+                    self.fetch_album_list_page, offset, priority=PRIORITY_LISTING
+                )
+                for offset in range(self.ALBUM_LIST_LIMIT, total, self.ALBUM_LIST_LIMIT)
+            ]
+            for page in pages:
+                albums.extend(page.result()[0])
+        return largest_first(albums)
+
+    def album_page_urls(self, album: JSONType) -> List[str]:
+        return [
+            self.ALBUM_PAGE_URL.format(
+                user_id=self.user_id, album_id=album["albumId"], page=i + 1
+            )
+            for i in range(int(album["photoCount"] // 100) + 1)
+        ]
+
+    def fetch_album_page(self, album: JSONType, url: str) -> List[str]:
+        with self.metrics.timer("stage_seconds", stage="album_page"):
+            data = json.loads(self.fetch_text(url))
+            photo_list = [image["url"] for image in data["photoList"]]
+        self.state.add_album_photos(album, photo_list)
+        return photo_list
+
+    def download_image(self, url: str, name: str) -> int:
+        if self.output.exists(name):
+            # The size recorded with the blob saves a stat per photo.
+            blob = self.state.get_blob(url)
+            return blob["size"] if blob else self.output.size(name)
+        blob = self.fetch_blob(url)
+        with self.metrics.timer("stage_seconds", stage="write"):
+            self.output.link_blob(blob["digest"], name)
+        return blob["size"]
+
+    def fetch_blob(self, url: str) -> JSONType:
+        """Return the stored blob of a photo. A download of the same URL
+        already in flight for another album is waited for, not repeated.
+        """
+        with self._downloads_lock:
+            future = self._downloads.get(url)
+            owner = future is None
+            if owner:
+                future = self._downloads[url] = Future()
+        if not owner:
+            return future.result()
+        try:
+            blob = self._download_blob(url)
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        else:
+            future.set_result(blob)
+        finally:
+            with self._downloads_lock:
+                del self._downloads[url]
+        return blob
+
+    def _download_blob(self, url: str) -> JSONType:
+        # Photos shared between albums are fetched once, other albums get a
+        # link to the stored blob.
+        blob = self.state.get_blob(url)
+        if blob is None or not self.output.has_blob(blob["digest"]):
+            with self.metrics.timer("stage_seconds", stage="photo"):
+                blob = self.retrying(
+                    self._fetch_blob, url, progress=lambda: self.partial_download(url).size
+                )
+            self.state.record_blob(url, blob["digest"], blob["size"])
+        return blob
+
+    def _fetch_blob(self, url: str) -> JSONType:
+        partial = self.partial_download(url)
+        if partial.complete():
+            return self.import_partial(partial)
+        host = urlsplit(url).hostname
+        with self._get(url, stream=True, headers=partial.resume_headers()) as r:
+            length = int(r.headers.get("Content-Length") or 0)
+            # Small photos are cheap to fetch again and skip the part file.
+            if not partial.size and length < self.RESUME_MIN_SIZE:
+                with self.output.blob_writer() as blob:
+                    for chunk in r.iter_content(self.CHUNK_SIZE):
+                        self.on_chunk(len(chunk))
+                        blob.write(chunk)
+                self.metrics.inc("http_response_bytes_total", blob.size, host=host)
+                return {"digest": blob.digest, "size": blob.size}
+            f = partial.begin(r.status_code, r.headers)
+            if f is None:
+                raise IncompleteDownload(f"{url}: range doesn't continue the part file")
+            if r.status_code == 206:
+                self.metrics.inc("downloads_resumed_total")
+            received = 0
+            with f:
+                for chunk in r.iter_content(self.CHUNK_SIZE):
+                    self.on_chunk(len(chunk))
+                    f.write(chunk)
+                    received += len(chunk)
+        self.metrics.inc("http_response_bytes_total", received, host=host)
+        return self.import_partial(partial)
+
+    def partial_download(self, url: str) -> PartialDownload:
+        return PartialDownload(os.path.join(self.data_dir, self.PARTIAL_DIR), url)
+
+    def import_partial(self, partial: PartialDownload) -> JSONType:
+        """Check a finished part file and store it as a blob."""
+        partial.finish()
+        digest, size = self.output.import_blob(partial.path)
+        partial.discard()
+        return {"digest": digest, "size": size}
+
+    def album_saved(self, album: JSONType) -> bool:
+        """Whether a finished album is still complete in the output."""
+        if self.refresh or not self.state.album_done(album):
+            return False
+        if self.output.durable:
+            return True
+        album_name = album_dirname(album)
+        return all(
+            self.output.exists(photo_name(album_name, url))
+            for url in self.state.album_photos(album)
+        )
 
-        download_dir = os.path.join(self.output_dir, "albums", album_name)
-        if not os.path.isdir(download_dir):
-            os.makedirs(download_dir)
+    def saved_photos(self, album: JSONType) -> Set[str]:
+        """URLs of the photos of an album already in the output."""
+        fetched = self.state.fetched_photos(album)
+        if self.output.durable:
+            return fetched
+        album_name = album_dirname(album)
+        return {url for url in fetched if self.output.exists(photo_name(album_name, url))}
 
-        def download_image(image: JSONType, callback: SimpleCallback) -> None:
-            url = image["url"]
-            image_path = os.path.join(download_dir, os.path.basename(url))
-            if os.path.isfile(image_path):
-                callback()
-                return
-            r = self.s.get(url)
-            r.raise_for_status()
-            with open(image_path, "wb") as f:
-                f.write(r.content)
-            callback()
+    def download_album(self, album: JSONType) -> None:
+        if self.album_saved(album):
+            return
+        album_name = album_dirname(album)
+        listed = not self.refresh and self.state.album_listed(album)
+        fetched = self.saved_photos(album)
 
         t = self.ui.progressbar(
             total=int(album["photoCount"]), desc=f"Dumping album {album_name}"
         )
-        for image in photo_list:
-            download_image(image, t.update)
+        t.update(len(fetched))
+        # All album pages are requested up front and the photos of each page
+        # are queued as soon as it arrives, so listing and downloading overlap.
+        # Workers only do the network and disk I/O, progress is reported from
+        # this thread as downloads complete.
+        pages = set()
+        downloads = {}
+
+        def submit_downloads(photo_list: List[str]) -> Set[Future]:
+            futures = {
+                self.scheduler.submit(
+                    self.download_image, url, photo_name(album_name, url),
+                    priority=PRIORITY_PHOTO,
+                ): url
+                for url in photo_list if url not in fetched
+            }
+            downloads.update(futures)
+            return set(futures)
+
+        if listed:
+            pending = submit_downloads(self.state.album_photos(album))
+        else:
+            pages = {
+                self.scheduler.submit(
+                    self.fetch_album_page, album, url, priority=PRIORITY_LISTING
+                )
+                for url in self.album_page_urls(album)
+            }
+            pending = set(pages)
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future in pages:
+                    pending |= submit_downloads(future.result())
+                    continue
+                url = downloads[future]
+                self.state.record_photo(
+                    album, url, photo_name(album_name, url), future.result()
+                )
+                t.update()
+        if not listed:
+            self.state.mark_album_listed(album)
+        self.state.mark_album_done(album)
 
     def dump_albums(self) -> None:
-        for album in self.parse_album_list():
-            self.download_album(album)
+        # Photos are not cached, an offline run leaves them as they are.
+        if self.offline:
+            return
+        # A few albums are listed and queued at a time, so the scheduler
+        # always has photos to work on while the largest albums go first.
+        with ThreadPoolExecutor(max_workers=self.ALBUMS_IN_FLIGHT) as albums:
+            futures = [
+                albums.submit(self.download_album, album) for album in self.parse_album_list()
+            ]
+            for future in futures:
+                future.result()
+
+    def iter_article_pages(self) -> Iterator[List[JSONType]]:
+        """Yield the articles of each blog list page as soon as it is parsed."""
+        from parsing import parse_article_page
+
+        if self.state.feed_done("articles"):
+            yield self.state.articles()
+            if self.incremental and not self.offline:
+                yield from self.iter_new_article_pages()
+            return
+        url = self.ARTICLE_LIST_URL.format(user_id=self.user_id)
+        while url:
+            with self.metrics.timer("stage_seconds", stage="article_list"):
+                items, url = parse_article_page(self.fetch_text(url))
+            self.state.add_articles(items)
+            yield items
+        self.state.mark_feed_done("articles")
+
+    def iter_new_article_pages(self) -> Iterator[List[JSONType]]:
+        """Yield the articles posted since the last run. The list is newest
+        first, so paging stops at the first page with a known article.
+        """
+        from parsing import parse_article_page
+
+        known = {article["url"] for article in self.state.articles()}
+        url = self.ARTICLE_LIST_URL.format(user_id=self.user_id)
+        while url:
+            with self.metrics.timer("stage_seconds", stage="article_list"):
+                items, url = parse_article_page(self.fetch_text(url))
+            new = [item for item in items if item["url"] not in known]
+            self.state.add_articles(new)
+            yield new
+            if len(new) < len(items):
+                break
 
     def parse_article_list(self) -> List[JSONType]:
-        start_url = f'http://3g.renren.com/blog/wmyblog.do?id={self.user_id}'
-        results = []
-        if not os.path.isdir(f"{self.output_dir}/articles"):
-            os.makedirs(f"{self.output_dir}/articles")
-
-        def _parse_one_page(url):
-            resp = self.s.get(url)
-            tree = lxml.html.fromstring(resp.text)
-            for element in tree.xpath('//div[@class="list"]/div[not(@class)]'):
-                item = {
-                    'title': element.xpath('a/text()')[0].strip(),
-                    'url': element.xpath('a/@href')[0].strip(),
-                    'createTime': element.xpath('p/text()')[0].strip()
-                }
-                results.append(item)
-            next_url = tree.xpath('//a[@title="下一页"]/@href')
-            if next_url:
-                _parse_one_page(next_url[0].strip())
-
-        _parse_one_page(start_url)
-        return results
-
-    def download_article(self, article: JSONType, callback: SimpleCallback) -> None:
-        url = article["url"].replace('flag=0', 'flag=1')
-        title = article["title"]
-        datetime = article["createTime"]
-        if os.path.isfile(f"{self.output_dir}/articles/{title}.md"):
+        return [item for items in self.iter_article_pages() for item in items]
+
+    def fetch_article(self, article: JSONType) -> Optional[Future]:
+        """Fetch an article and queue it for conversion, return None if it is
+        already saved.
+        """
+        if not self.offline and self.output.exists(article_name(article)):
+            return None
+        try:
+            with self.metrics.timer("stage_seconds", stage="article"):
+                text = self.fetch_text(article["url"].replace('flag=0', 'flag=1'))
+        except NotCached:
+            return None
+        return self.convert(render_article, article, text)
+
+    def convert(self, fn: Callable[..., T], *args) -> "Future[T]":
+        return self.metrics.time_future(
+            self.converter.submit(fn, *args), "stage_seconds", stage="convert"
+        )
+
+    def save_article(self, article: JSONType, content: str) -> None:
+        name = article_name(article)
+        with self.metrics.timer("stage_seconds", stage="write"), \
+                self.output.open(name, "w") as f:
+            f.write(content)
+        self.state.record_article(article, name, len(content))
+
+    def download_article(
+        self, article: JSONType, callback: Optional[SimpleCallback] = None
+    ) -> None:
+        converting = self.fetch_article(article)
+        if converting is not None:
+            self.save_article(article, converting.result())
+        if callback is not None:
             callback()
-            return
-        resp = self.s.get(url)
-        resp.raise_for_status()
-        text = re.findall(
-            r'<div class="con">([\s\S]*?)</div>',
-            resp.text,
-        )[0].strip()
-        template = """\
-{title}
-=======
-日期: {datetime}
 
-{content}
-"""
-        with open(f"{self.output_dir}/articles/{title}.md", "w", encoding="utf-8") as f:
-            f.write(
-                template.format(
-                    title=title, datetime=datetime, content=html2text.html2text(text)
-                )
-            )
-        callback()
+    def saved_articles(self) -> Set[str]:
+        """URLs of the articles already in the output."""
+        if self.output.durable:
+            return self.state.fetched_articles()
+        return {
+            url for url, name in self.state.fetched_article_paths().items()
+            if self.output.exists(name)
+        }
 
     def dump_articles(self) -> None:
-        articles = self.parse_article_list()
-        t = self.ui.progressbar(total=len(articles), desc="Dumping articles")
-        for article in articles:
-            self.download_article(article, t.update)
+        fetched = set() if self.offline else self.saved_articles()
+        # The number of articles is only known once the last list page is
+        # read, the bar total grows as pages come in.
+        t = self.ui.progressbar(total=0, desc="Dumping articles")
+        # Maps fetches and conversions in flight to their article. A finished
+        # fetch yields the future of its conversion, which is waited on next.
+        pending: Dict[Future, JSONType] = {}
+
+        def finish(futures: Set[Future]) -> None:
+            for future in futures:
+                article = pending.pop(future)
+                result = future.result()
+                if isinstance(result, Future):
+                    pending[result] = article
+                    continue
+                if result is not None:
+                    self.save_article(article, result)
+                t.update()
+
+        # Listing and downloading overlap, only a bounded number of
+        # downloads is queued ahead of the list walker.
+        for items in self.iter_article_pages():
+            t.total += len(items)
+            for article in items:
+                if article["url"] in fetched:
+                    t.update()
+                    continue
+                pending[self.scheduler.submit(self.fetch_article, article)] = article
+                if len(pending) >= self.concurrency * 2:
+                    finish(wait(pending, return_when=FIRST_COMPLETED).done)
+        while pending:
+            finish(wait(pending, return_when=FIRST_COMPLETED).done)
+
+    def fetch_status_page(self, page: int) -> JSONType:
+        data = self.state.get_status_page(page)
+        if data is None:
+            url = self.STATUS_URL.format(user_id=self.user_id, page=page)
+            with self.metrics.timer("stage_seconds", stage="status_page"):
+                text = self.fetch_text(url)
+            self.state.record_status_page(page, url, text)
+            data = json.loads(text)
+        return data
+
+    def convert_status_page(self, page: int) -> Tuple[int, Future]:
+        """Fetch a status page and queue it for conversion, return the number
+        of entries and the future of the rendered text.
+        """
+        items = self.fetch_status_page(page)["doingArray"]
+        return len(items), self.convert(render_status_page, items)
+
+    def newest_status(self) -> Optional[int]:
+        newest = self.state.feed_newest("status")
+        if newest is None:
+            # State from before the newest entry was recorded still has the
+            # first page.
+            page = self.state.get_status_page(0)
+            if page and page["doingArray"]:
+                newest = page["doingArray"][0]["id"]
+        return int(newest) if newest is not None else None
+
+    def sync_status(self, newest: int) -> None:
+        """Put the entries posted since the last run at the top of status.md.
+        The feed is newest first, so paging stops at the first known entry.
+        """
+        progressbar = self.ui.progressbar(total=0, desc="Syncing status")
+        fresh = []
+        page = 0
+        while True:
+            url = self.STATUS_URL.format(user_id=self.user_id, page=page)
+            with self.metrics.timer("stage_seconds", stage="status_page"):
+                data = json.loads(self.fetch_text(url))
+            items = data["doingArray"]
+            new = [item for item in items if int(item["id"]) > newest]
+            fresh.extend(new)
+            page += 1
+            if len(new) < len(items) or page * self.STATUS_PAGE_SIZE >= data["count"]:
+                break
+        progressbar.total = len(fresh)
+        if fresh:
+            text = self.convert(render_status_page, fresh).result()
+            with self.metrics.timer("stage_seconds", stage="write"):
+                self.output.prepend("status.md", text)
+            self.record_status_sync(fresh[0])
+        progressbar.update(len(fresh))
+
+    def record_status_sync(self, newest: JSONType) -> None:
+        # The new entries moved every older one to a later page, so the
+        # stored and cached pages are dropped.
+        self.state.reset_feed("status")
+        if self.cache is not None:
+            self.cache.discard(self.STATUS_URL.format(user_id=self.user_id, page=""))
+        self.state.mark_feed_done("status")
+        self.state.set_feed_newest("status", str(newest["id"]))
 
     def dump_status(self) -> None:
-        url = f"http://status.renren.com/GetSomeomeDoingList.do?userId={self.user_id}&curpage="
-        i = 0
-        total = 0
-        results = []
-        while i == 0 or i * 20 < total:
-            r = self.s.get(url + str(i))
-            r.raise_for_status()
-            data = r.json()
-            if not total:
-                total = data["count"]
-            results.extend(data["doingArray"])
-            i += 1
-
-        if not os.path.isdir(f"{self.output_dir}"):
-            os.makedirs(f"{self.output_dir}")
-
-        with open(f"{self.output_dir}/status.md", "w", encoding="utf-8") as f:
-            progressbar = self.ui.progressbar(total=len(results), desc="Dumping status")
-            for item in results:
-                if item.get("location"):
-                    heading = f"{item['dtime']} 在 {item['location']}"
-                else:
-                    heading = item['dtime']
-                content = html2text.html2text(item['content'])
-                f.write(f"### {heading}\n\n{content}\n\n")
-                progressbar.update()
+        if (
+            not self.offline and self.state.feed_done("status")
+            and self.output.exists("status.md")
+        ):
+            # Archives can't replace a member, so a finished status.md is
+            # kept, or only gets new entries added.
+            if not self.incremental:
+                return
+            newest = self.newest_status()
+            if newest is not None:
+                self.sync_status(newest)
+                return
+            self.state.reset_feed("status")
+        try:
+            self.write_status()
+        except NotCached:
+            # Offline with part of the feed missing from the cache, the
+            # status.md there is kept rather than cut short.
+            return
+
+    def status_outdated(self, first: JSONType) -> bool:
+        """Whether the first status page is older than the newest entry in
+        status.md, as happens with a cache from before an incremental run.
+        """
+        newest = self.state.feed_newest("status")
+        items = first["doingArray"]
+        return newest is not None and (not items or int(items[0]["id"]) < int(newest))
+
+    def write_status(self) -> None:
+        first = self.fetch_status_page(0)
+        if self.offline and self.status_outdated(first):
+            return
+        page_count = -(-first["count"] // self.STATUS_PAGE_SIZE)
+
+        progressbar = self.ui.progressbar(total=first["count"], desc="Dumping status")
+        # Later pages are fetched and converted in parallel but written
+        # strictly in order. At most STATUS_WINDOW pages are requested ahead
+        # of the one being written, which bounds how much of the history is
+        # held in memory.
+        with self.output.open("status.md", "w") as f:
+            window = deque()
+            next_page = 0
+            while next_page < page_count or window:
+                while next_page < page_count and len(window) < self.STATUS_WINDOW:
+                    window.append(self.scheduler.submit(self.convert_status_page, next_page))
+                    next_page += 1
+                count, text = window.popleft().result()
+                text = text.result()
+                with self.metrics.timer("stage_seconds", stage="write"):
+                    f.write(text)
+                progressbar.update(count)
+        self.state.mark_feed_done("status")
+        if first["doingArray"]:
+            self.state.set_feed_newest("status", str(first["doingArray"][0]["id"]))
+
+    def start_metrics(self) -> None:
+        self.metrics = metrics = Metrics()
+        metrics.gauge(
+            "scheduler_queue_depth", lambda: self.scheduler.queue_depth if self.scheduler else 0
+        )
+        metrics.gauge("limiter_waiting", lambda: self.limiter.waiting if self.limiter else 0)
+        metrics.gauge("requests_in_flight", lambda: self.limiter.in_flight if self.limiter else 0)
+        metrics.gauge("request_window", lambda: self.limiter.window.limit if self.limiter else 0)
+        metrics.gauge("converter_pending", lambda: self.converter.pending if self.converter else 0)
+        metrics.start_sampler()
+        if self.metrics_port:
+            metrics.serve(self.metrics_port)
+        # Connections record into the metrics of the run.
+        self._mount_adapters()
+
+    def stop_metrics(self) -> None:
+        if self.metrics_file:
+            self.metrics.write_report(self.metrics_file)
+        self.metrics.close()
 
     def main(self, ui) -> None:
         self.ui = ui
-        self.dump_albums()
-        self.dump_articles()
-        self.dump_status()
+        self.bytes_transferred = 0
+        self._cancelled.clear()
+        self.start_metrics()
+        self.open_output()
+        try:
+            # Each category is driven by its own coordinator thread, while all
+            # the actual requests go through one shared scheduler.
+            with Scheduler(self.concurrency, self.bandwidth) as self.scheduler, \
+                    Converter(self.convert_workers) as self.converter, \
+                    ThreadPoolExecutor(max_workers=len(self.categories)) as coordinators:
+                self.limiter = self.scheduler.limiter
+                futures = [
+                    coordinators.submit(getattr(self, f"dump_{category}"))
+                    for category in self.categories
+                ]
+                try:
+                    for future in futures:
+                        future.result()
+                except KeyboardInterrupt:
+                    # Cancel before the pools wait for their threads, so
+                    # downloads in flight stop at their next chunk.
+                    self.cancel()
+                    raise
+        finally:
+            self.scheduler = None
+            self.limiter = None
+            self.converter = None
+            self.close_output()
+            self.stop_metrics()
+
+
+ENGINES = {
+    "sync": "spider:RenrenSpider",
+    "async": "async_spider:AsyncRenrenSpider",
+}
+
+
+def get_spider_class(engine: str = "sync") -> type:
+    module_name, _, class_name = ENGINES[engine].partition(":")
+    module = importlib.import_module(module_name)
+    return getattr(module, class_name)
 
 
 if __name__ == "__main__":
-    parser = argparse.ArgumentParser()
-    parser.add_argument(
-        "-k",
-        "--keep",
-        default=False,
-        action="store_true",
-        help="Whether keep the login cookies",
-    )
-    parser.add_argument("--user", help="Specify the user ID to parse")
-    parser.add_argument(
-        "--email",
-        default=os.getenv("RENREN_EMAIL"),
-        help="Login email, defaults to envvar RENREN_EMAIL",
-    )
-    parser.add_argument(
-        "--password",
-        default=os.getenv("RENREN_PASSWD"),
-        help="Login password, defaults to envvar RENREN_PASSWD",
-    )
-    parser.add_argument(
-        "-o", "--output", default="output", help="Specify output directory"
-    )
-    args = parser.parse_args()
-    spider = RenrenSpider(args)
-    spider.main()
+    from cli import main
+
+    main()
@@ -108,6 +108,20 @@ class Ui_Dialog(object):
         self.progressBar.setProperty("value", 0)
         self.progressBar.setObjectName("progressBar")
         self.verticalLayout_2.addWidget(self.progressBar)
+        self.statsLabel = QtWidgets.QLabel(self.progressFrame)
+        self.statsLabel.setText("")
+        self.statsLabel.setObjectName("statsLabel")
+        self.verticalLayout_2.addWidget(self.statsLabel)
+        self.horizontalLayout_3 = QtWidgets.QHBoxLayout()
+        self.horizontalLayout_3.setObjectName("horizontalLayout_3")
+        self.pauseBtn = QtWidgets.QPushButton(self.progressFrame)
+        self.pauseBtn.setCheckable(True)
+        self.pauseBtn.setObjectName("pauseBtn")
+        self.horizontalLayout_3.addWidget(self.pauseBtn)
+        self.cancelBtn = QtWidgets.QPushButton(self.progressFrame)
+        self.cancelBtn.setObjectName("cancelBtn")
+        self.horizontalLayout_3.addWidget(self.cancelBtn)
+        self.verticalLayout_2.addLayout(self.horizontalLayout_3)
         self.verticalLayout_3.addWidget(self.progressFrame)
         self.copyright = QtWidgets.QLabel(Dialog)
         self.copyright.setGeometry(QtCore.QRect(20, 360, 471, 16))
@@ -130,6 +144,8 @@ class Ui_Dialog(object):
         self.browserBtn.setText(QtWidgets.QApplication.translate("Dialog", "浏览...", None, -1))
         self.userInput.setPlaceholderText(QtWidgets.QApplication.translate("Dialog", "输入用户ID，若空则获取本账号", None, -1))
         self.startBtn.setText(QtWidgets.QApplication.translate("Dialog", "开始", None, -1))
+        self.pauseBtn.setText(QtWidgets.QApplication.translate("Dialog", "暂停", None, -1))
+        self.cancelBtn.setText(QtWidgets.QApplication.translate("Dialog", "取消", None, -1))
         self.copyright.setText(QtWidgets.QApplication.translate("Dialog", "Copyright©2019 by Frost Ming <a href=\"https://github.com/frostming/renren-dumps\">https://github.com/frostming/renren-dumps</a>", None, -1))
 
 import resource_rc
@@ -0,0 +1,254 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import json
+import sqlite3
+import threading
+import time
+from typing import Dict, Iterable, List, Optional, Set
+
+JSONType = Dict[str, object]
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS albums (
+    album_id TEXT PRIMARY KEY,
+    name TEXT,
+    photo_count INTEGER,
+    listed INTEGER NOT NULL DEFAULT 0,
+    done INTEGER NOT NULL DEFAULT 0,
+    updated_at REAL
+);
+CREATE TABLE IF NOT EXISTS photos (
+    album_id TEXT NOT NULL,
+    url TEXT NOT NULL,
+    path TEXT,
+    size INTEGER,
+    fetched_at REAL,
+    PRIMARY KEY (album_id, url)
+);
+CREATE TABLE IF NOT EXISTS blobs (
+    url TEXT PRIMARY KEY,
+    digest TEXT NOT NULL,
+    size INTEGER,
+    fetched_at REAL
+);
+CREATE TABLE IF NOT EXISTS feeds (
+    name TEXT PRIMARY KEY,
+    done INTEGER NOT NULL DEFAULT 0,
+    newest TEXT,
+    updated_at REAL
+);
+CREATE TABLE IF NOT EXISTS articles (
+    url TEXT PRIMARY KEY,
+    title TEXT,
+    create_time TEXT,
+    path TEXT,
+    size INTEGER,
+    fetched_at REAL
+);
+CREATE TABLE IF NOT EXISTS status_pages (
+    page INTEGER PRIMARY KEY,
+    url TEXT,
+    data TEXT,
+    size INTEGER,
+    fetched_at REAL
+);
+"""
+
+
+class CrawlState:
+    """Record of what a dump has already fetched, stored next to the output.
+
+    Listing results are kept too, so a rerun can skip finished albums, blog
+    pages and status pages without going to the network at all.
+    """
+
+    FILENAME = ".renren_state.db"
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript(SCHEMA)
+        # Added after the first release, older state files lack it.
+        columns = {row[1] for row in self._conn.execute("PRAGMA table_info(feeds)")}
+        if "newest" not in columns:
+            self._conn.execute("ALTER TABLE feeds ADD COLUMN newest TEXT")
+        self._conn.commit()
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
+
+    def _query(self, sql: str, params: Iterable = ()) -> List[tuple]:
+        with self._lock:
+            return self._conn.execute(sql, tuple(params)).fetchall()
+
+    def _execute(self, sql: str, params: Iterable = ()) -> None:
+        with self._lock:
+            self._conn.execute(sql, tuple(params))
+            self._conn.commit()
+
+    def _executemany(self, sql: str, rows: Iterable[Iterable]) -> None:
+        with self._lock:
+            self._conn.executemany(sql, [tuple(row) for row in rows])
+            self._conn.commit()
+
+    # Albums and photos
+
+    def get_album(self, album_id) -> Optional[JSONType]:
+        rows = self._query(
+            "SELECT name, photo_count, listed, done FROM albums WHERE album_id = ?",
+            (str(album_id),),
+        )
+        if not rows:
+            return None
+        name, photo_count, listed, done = rows[0]
+        return {
+            "name": name, "photo_count": photo_count,
+            "listed": bool(listed), "done": bool(done),
+        }
+
+    def album_listed(self, album: JSONType) -> bool:
+        record = self.get_album(album["albumId"])
+        return bool(
+            record and record["listed"]
+            and record["photo_count"] == int(album["photoCount"])
+        )
+
+    def album_done(self, album: JSONType) -> bool:
+        record = self.get_album(album["albumId"])
+        return bool(
+            record and record["done"]
+            and record["photo_count"] == int(album["photoCount"])
+        )
+
+    def add_album_photos(self, album: JSONType, urls: Iterable[str]) -> None:
+        album_id = str(album["albumId"])
+        self._executemany(
+            "INSERT OR IGNORE INTO photos (album_id, url) VALUES (?, ?)",
+            ((album_id, url) for url in urls),
+        )
+
+    def mark_album_listed(self, album: JSONType) -> None:
+        self._execute(
+            "INSERT INTO albums (album_id, name, photo_count, listed, updated_at) "
+            "VALUES (?, ?, ?, 1, ?) ON CONFLICT(album_id) DO UPDATE SET "
+            "name = excluded.name, photo_count = excluded.photo_count, "
+            "listed = 1, done = 0, updated_at = excluded.updated_at",
+            (str(album["albumId"]), album["albumName"], int(album["photoCount"]), time.time()),
+        )
+
+    def mark_album_done(self, album: JSONType) -> None:
+        self._execute(
+            "UPDATE albums SET done = 1, updated_at = ? WHERE album_id = ?",
+            (time.time(), str(album["albumId"])),
+        )
+
+    def album_photos(self, album: JSONType) -> List[str]:
+        return [row[0] for row in self._query(
+            "SELECT url FROM photos WHERE album_id = ? ORDER BY rowid",
+            (str(album["albumId"]),),
+        )]
+
+    def fetched_photos(self, album: JSONType) -> Set[str]:
+        return {row[0] for row in self._query(
+            "SELECT url FROM photos WHERE album_id = ? AND fetched_at IS NOT NULL",
+            (str(album["albumId"]),),
+        )}
+
+    def record_photo(self, album: JSONType, url: str, path: str, size: int) -> None:
+        self._execute(
+            "INSERT INTO photos (album_id, url, path, size, fetched_at) "
+            "VALUES (?, ?, ?, ?, ?) ON CONFLICT(album_id, url) DO UPDATE SET "
+            "path = excluded.path, size = excluded.size, fetched_at = excluded.fetched_at",
+            (str(album["albumId"]), url, path, size, time.time()),
+        )
+
+    def get_blob(self, url: str) -> Optional[JSONType]:
+        rows = self._query("SELECT digest, size FROM blobs WHERE url = ?", (url,))
+        if not rows:
+            return None
+        return {"digest": rows[0][0], "size": rows[0][1]}
+
+    def record_blob(self, url: str, digest: str, size: int) -> None:
+        self._execute(
+            "INSERT OR REPLACE INTO blobs (url, digest, size, fetched_at) VALUES (?, ?, ?, ?)",
+            (url, digest, size, time.time()),
+        )
+
+    # Feeds: blog list and status pages
+
+    def feed_done(self, name: str) -> bool:
+        rows = self._query("SELECT done FROM feeds WHERE name = ?", (name,))
+        return bool(rows and rows[0][0])
+
+    def mark_feed_done(self, name: str, done: bool = True) -> None:
+        self._execute(
+            "INSERT INTO feeds (name, done, updated_at) VALUES (?, ?, ?) "
+            "ON CONFLICT(name) DO UPDATE SET done = excluded.done, updated_at = excluded.updated_at",
+            (name, int(done), time.time()),
+        )
+
+    def feed_newest(self, name: str) -> Optional[str]:
+        """Return the ID of the newest item a feed had when last read."""
+        rows = self._query("SELECT newest FROM feeds WHERE name = ?", (name,))
+        return rows[0][0] if rows else None
+
+    def set_feed_newest(self, name: str, newest: str) -> None:
+        self._execute(
+            "INSERT INTO feeds (name, newest, updated_at) VALUES (?, ?, ?) "
+            "ON CONFLICT(name) DO UPDATE SET newest = excluded.newest, "
+            "updated_at = excluded.updated_at",
+            (name, newest, time.time()),
+        )
+
+    def add_articles(self, articles: Iterable[JSONType]) -> None:
+        self._executemany(
+            "INSERT OR IGNORE INTO articles (url, title, create_time) VALUES (?, ?, ?)",
+            ((item["url"], item["title"], item["createTime"]) for item in articles),
+        )
+
+    def articles(self) -> List[JSONType]:
+        return [
+            {"url": url, "title": title, "createTime": create_time}
+            for url, title, create_time in self._query(
+                "SELECT url, title, create_time FROM articles ORDER BY rowid"
+            )
+        ]
+
+    def fetched_articles(self) -> Set[str]:
+        return {row[0] for row in self._query(
+            "SELECT url FROM articles WHERE fetched_at IS NOT NULL"
+        )}
+
+    def fetched_article_paths(self) -> Dict[str, str]:
+        return dict(self._query(
+            "SELECT url, path FROM articles WHERE fetched_at IS NOT NULL"
+        ))
+
+    def record_article(self, article: JSONType, path: str, size: int) -> None:
+        self._execute(
+            "INSERT INTO articles (url, title, create_time, path, size, fetched_at) "
+            "VALUES (?, ?, ?, ?, ?, ?) ON CONFLICT(url) DO UPDATE SET "
+            "path = excluded.path, size = excluded.size, fetched_at = excluded.fetched_at",
+            (article["url"], article["title"], article["createTime"], path, size, time.time()),
+        )
+
+    def get_status_page(self, page: int) -> Optional[JSONType]:
+        rows = self._query("SELECT data FROM status_pages WHERE page = ?", (page,))
+        return json.loads(rows[0][0]) if rows else None
+
+    def record_status_page(self, page: int, url: str, data: str) -> None:
+        self._execute(
+            "INSERT OR REPLACE INTO status_pages (page, url, data, size, fetched_at) "
+            "VALUES (?, ?, ?, ?, ?)",
+            (page, url, data, len(data), time.time()),
+        )
+
+    def reset_feed(self, name: str) -> None:
+        """Forget a feed listing so the next run pages through it again."""
+        self.mark_feed_done(name, False)
+        if name == "status":
+            self._execute("DELETE FROM status_pages")
@@ -0,0 +1,361 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""HTTP transports of the sync engine.
+
+Photos are served by several CDN hosts besides the listing hosts. Each host
+gets its own connection pool, host names are resolved once per DNS_TTL
+rather than on every new connection, and the time spent resolving and
+connecting is recorded per host, so connection churn shows up in the
+metrics report.
+
+The ``http2`` transport sends the requests of the session through httpx
+instead, see Http2Adapter.
+"""
+import email.message
+import importlib.util
+import os
+import socket
+import ssl
+import threading
+import time
+from types import SimpleNamespace
+from typing import Dict, Iterator, List, Optional, Tuple, Union
+from urllib.parse import urlsplit
+
+from requests import PreparedRequest, Response, exceptions
+from requests.adapters import BaseAdapter, HTTPAdapter
+from requests.structures import CaseInsensitiveDict
+from requests.utils import DEFAULT_CA_BUNDLE_PATH, get_encoding_from_headers, select_proxy
+from urllib3 import PoolManager, ProxyManager
+from urllib3.connection import HTTPConnection, HTTPSConnection
+from urllib3.exceptions import ConnectTimeoutError, NewConnectionError
+from urllib3.util.connection import create_connection
+
+from metrics import Metrics
+
+AddrInfo = Tuple[int, int, int, str, tuple]
+Cert = Union[None, str, Tuple[str, str]]
+
+DNS_TTL = 300.0
+TRANSPORTS = ("http1", "http2")
+# Headers about the connection itself, HTTP/2 forbids them.
+HOP_BY_HOP_HEADERS = ("connection", "keep-alive", "proxy-connection", "transfer-encoding", "upgrade")
+
+
+def keepalive_options() -> List[Tuple[int, int, int]]:
+    """Socket options probing idle pooled connections, so ones dropped by a
+    NAT or firewall are noticed before a request is sent on them.
+    """
+    options = list(HTTPConnection.default_socket_options)
+    options.append((socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1))
+    # The names differ by platform, Windows has none of them.
+    for name, value in (("TCP_KEEPIDLE", 60), ("TCP_KEEPINTVL", 15), ("TCP_KEEPCNT", 4)):
+        if hasattr(socket, name):
+            options.append((socket.IPPROTO_TCP, getattr(socket, name), value))
+    return options
+
+
+class DNSCache:
+    """Resolved addresses by host and port, kept for ``ttl`` seconds."""
+
+    def __init__(self, metrics: Metrics, ttl: float = DNS_TTL) -> None:
+        self.metrics = metrics
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._entries: Dict[Tuple[str, int], Tuple[float, List[AddrInfo]]] = {}
+
+    def resolve(self, host: str, port: int) -> List[AddrInfo]:
+        with self._lock:
+            entry = self._entries.get((host, port))
+        if entry is not None and entry[0] > time.monotonic():
+            self.metrics.inc("dns_cache_hits_total", host=host)
+            return entry[1]
+        started = time.perf_counter()
+        infos = socket.getaddrinfo(host, port, 0, socket.SOCK_STREAM)
+        self.metrics.observe("dns_lookup_seconds", time.perf_counter() - started, host=host)
+        with self._lock:
+            self._entries[(host, port)] = (time.monotonic() + self.ttl, infos)
+        return infos
+
+    def forget(self, host: str, port: int) -> None:
+        with self._lock:
+            self._entries.pop((host, port), None)
+
+
+class _InstrumentedConnection:
+    def __init__(self, *args, resolver: DNSCache, metrics: Metrics, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        self.resolver = resolver
+        self.metrics = metrics
+
+    def _new_conn(self) -> socket.socket:
+        # Same as urllib3, with the addresses coming from the cache.
+        host = self._dns_host
+        try:
+            infos = self.resolver.resolve(host, self.port)
+        except socket.gaierror as e:
+            raise NewConnectionError(self, f"Failed to resolve '{host}' ({e})") from e
+        error = None
+        for *_, sockaddr in infos:
+            try:
+                return create_connection(
+                    sockaddr[:2], self.timeout,
+                    source_address=self.source_address, socket_options=self.socket_options,
+                )
+            except socket.timeout as e:
+                raise ConnectTimeoutError(
+                    self, f"Connection to {host} timed out. (connect timeout={self.timeout})"
+                ) from e
+            except OSError as e:
+                error = e
+        # The host may have moved, look it up again next time.
+        self.resolver.forget(host, self.port)
+        raise NewConnectionError(
+            self, f"Failed to establish a new connection: {error}"
+        ) from error
+
+    def connect(self) -> None:
+        # Covers the TCP and, for HTTPS, the TLS handshake.
+        started = time.perf_counter()
+        super().connect()
+        self.metrics.observe("http_connect_seconds", time.perf_counter() - started, host=self.host)
+        self.metrics.inc("http_connections_total", host=self.host)
+
+
+class InstrumentedHTTPConnection(_InstrumentedConnection, HTTPConnection):
+    pass
+
+
+class InstrumentedHTTPSConnection(_InstrumentedConnection, HTTPSConnection):
+    pass
+
+
+class _InstrumentedPools:
+    CONNECTION_CLASSES = {"http": InstrumentedHTTPConnection, "https": InstrumentedHTTPSConnection}
+
+    def __init__(self, resolver: DNSCache, metrics: Metrics, *args, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        self.resolver = resolver
+        self.metrics = metrics
+
+    def _new_pool(self, scheme: str, host: str, port: int, request_context: Optional[dict] = None):
+        pool = super()._new_pool(scheme, host, port, request_context)
+        # Pool keyword arguments have to be known to urllib3, the extra
+        # connection arguments are set on the pool instead.
+        pool.ConnectionCls = self.CONNECTION_CLASSES[scheme]
+        pool.conn_kw.update(resolver=self.resolver, metrics=self.metrics)
+        return pool
+
+
+class InstrumentedPoolManager(_InstrumentedPools, PoolManager):
+    pass
+
+
+class InstrumentedProxyManager(_InstrumentedPools, ProxyManager):
+    pass
+
+
+class InstrumentedAdapter(HTTPAdapter):
+    """HTTPAdapter with a DNS cache, TCP keep-alive and per-host connect
+    metrics. ``pool_connections`` is the number of hosts whose pools are kept,
+    ``pool_maxsize`` the connections kept per host.
+    """
+
+    def __init__(self, metrics: Metrics, resolver: Optional[DNSCache] = None, **kwargs) -> None:
+        self.metrics = metrics
+        self.resolver = resolver or DNSCache(metrics)
+        super().__init__(**kwargs)
+
+    def init_poolmanager(self, connections: int, maxsize: int, block: bool = False, **pool_kwargs) -> None:
+        self._pool_connections = connections
+        self._pool_maxsize = maxsize
+        self._pool_block = block
+        pool_kwargs.setdefault("socket_options", keepalive_options())
+        self.poolmanager = InstrumentedPoolManager(
+            self.resolver, self.metrics,
+            num_pools=connections, maxsize=maxsize, block=block, **pool_kwargs,
+        )
+
+    def proxy_manager_for(self, proxy: str, **proxy_kwargs):
+        if proxy not in self.proxy_manager and not proxy.lower().startswith("socks"):
+            proxy_kwargs.setdefault("socket_options", keepalive_options())
+            self.proxy_manager[proxy] = InstrumentedProxyManager(
+                self.resolver, self.metrics, proxy,
+                proxy_headers=self.proxy_headers(proxy),
+                num_pools=self._pool_connections,
+                maxsize=self._pool_maxsize,
+                block=self._pool_block,
+                **proxy_kwargs,
+            )
+        return super().proxy_manager_for(proxy, **proxy_kwargs)
+
+
+def ssl_context(verify: Union[bool, str], cert: Cert) -> ssl.SSLContext:
+    """An SSL context for the ``verify`` and ``cert`` arguments of requests."""
+    if verify is False:
+        context = ssl.create_default_context()
+        context.check_hostname = False
+        context.verify_mode = ssl.CERT_NONE
+    else:
+        path = DEFAULT_CA_BUNDLE_PATH if verify is True else verify
+        if os.path.isdir(path):
+            context = ssl.create_default_context(capath=path)
+        else:
+            context = ssl.create_default_context(cafile=path)
+    if cert:
+        context.load_cert_chain(*((cert,) if isinstance(cert, str) else cert))
+    return context
+
+
+def _import_httpx():
+    try:
+        import httpx
+    except ImportError:
+        raise RuntimeError("The http2 transport requires httpx: pip install httpx[http2]")
+    return httpx
+
+
+class _RawResponse:
+    """The ``raw`` of a requests Response read from an httpx response."""
+
+    def __init__(self, response) -> None:
+        self._response = response
+        # requests stores the cookies of a response from this message.
+        msg = email.message.Message()
+        for value in response.headers.get_list("set-cookie"):
+            msg["Set-Cookie"] = value
+        self._original_response = SimpleNamespace(msg=msg)
+
+    def stream(self, amt: int = 64 * 1024, decode_content: bool = True) -> Iterator[bytes]:
+        httpx = _import_httpx()
+        response = self._response
+        try:
+            yield from response.iter_bytes(amt) if decode_content else response.iter_raw(amt)
+        except httpx.TimeoutException as e:
+            raise exceptions.ConnectionError(e)
+        except httpx.TransportError as e:
+            raise exceptions.ChunkedEncodingError(e)
+        finally:
+            response.close()
+
+    def read(self, amt: Optional[int] = None, decode_content: bool = True) -> bytes:
+        return b"".join(self.stream(decode_content=decode_content))
+
+    def close(self) -> None:
+        self._response.close()
+
+    release_conn = close
+
+
+class Http2Adapter(BaseAdapter):
+    """Sends the requests of a session through an httpx client.
+
+    Requests to a host are multiplexed over one HTTP/2 connection when the
+    server offers it with TLS ALPN. Other hosts, and every plain ``http://``
+    URL, get HTTP/1.1 on pooled connections, so the fallback is per host.
+    Cookies, redirects, retries, proxies and TLS settings stay with the
+    requests Session. There is an httpx client for each combination of
+    those settings in use, which is one in practice.
+
+    Connections and their connect time are recorded per host like the
+    default transport. DNS lookups happen within the connect time, there is
+    no lookup cache as HTTP/2 needs few connections.
+    """
+
+    def __init__(self, metrics: Metrics, pool_connections: int = 10, pool_maxsize: int = 10) -> None:
+        super().__init__()
+        _import_httpx()
+        if importlib.util.find_spec("h2") is None:
+            raise RuntimeError("The http2 transport requires h2: pip install httpx[http2]")
+        self.metrics = metrics
+        self.max_keepalive = pool_connections * pool_maxsize
+        self._lock = threading.Lock()
+        self._clients: Dict[tuple, object] = {}
+
+    def client(self, verify: Union[bool, str], cert: Cert, proxy: Optional[str]):
+        """Return the httpx client for these settings."""
+        httpx = _import_httpx()
+        key = (verify, cert, proxy)
+        with self._lock:
+            client = self._clients.get(key)
+            if client is None:
+                client = self._clients[key] = httpx.Client(
+                    http2=True,
+                    verify=ssl_context(verify, cert),
+                    proxy=proxy,
+                    limits=httpx.Limits(
+                        max_connections=None, max_keepalive_connections=self.max_keepalive,
+                    ),
+                    # The session already applied the environment.
+                    trust_env=False,
+                )
+            return client
+
+    def send(
+        self, request: PreparedRequest, stream: bool = False, timeout=None,
+        verify=True, cert=None, proxies=None,
+    ) -> Response:
+        httpx = _import_httpx()
+        url = urlsplit(request.url)
+        host = url.hostname
+        connect, read = timeout if isinstance(timeout, tuple) else (timeout, timeout)
+        # The connection is ready after the TCP connect, or the TLS handshake.
+        ready = "connection.start_tls.complete" if url.scheme == "https" \
+            else "connection.connect_tcp.complete"
+        started = [0.0]
+
+        def trace(event: str, info: dict) -> None:
+            if event == "connection.connect_tcp.started":
+                started[0] = time.perf_counter()
+            elif event == ready:
+                self.metrics.observe(
+                    "http_connect_seconds", time.perf_counter() - started[0], host=host
+                )
+                self.metrics.inc("http_connections_total", host=host)
+
+        headers = [
+            (name, value) for name, value in request.headers.items()
+            if name.lower() not in HOP_BY_HOP_HEADERS
+        ]
+        # Built directly rather than with the client, which would add its
+        # own cookies.
+        req = httpx.Request(
+            request.method, request.url, headers=headers, content=request.body,
+            extensions={
+                "timeout": httpx.Timeout(read, connect=connect).as_dict(),
+                "trace": trace,
+            },
+        )
+        if isinstance(cert, list):
+            cert = tuple(cert)
+        client = self.client(verify, cert, select_proxy(request.url, proxies))
+        try:
+            resp = client.send(req, stream=True)
+        except httpx.ProxyError as e:
+            raise exceptions.ProxyError(e, request=request)
+        except httpx.ConnectTimeout as e:
+            raise exceptions.ConnectTimeout(e, request=request)
+        except httpx.TimeoutException as e:
+            raise exceptions.ReadTimeout(e, request=request)
+        except httpx.TransportError as e:
+            raise exceptions.ConnectionError(e, request=request)
+        self.metrics.inc("http_versions_total", host=host, version=resp.http_version)
+        return self.build_response(request, resp)
+
+    def build_response(self, request: PreparedRequest, resp) -> Response:
+        response = Response()
+        response.status_code = resp.status_code
+        response.headers = CaseInsensitiveDict(resp.headers)
+        response.encoding = get_encoding_from_headers(response.headers)
+        response.reason = resp.reason_phrase
+        response.url = request.url
+        response.request = request
+        response.connection = self
+        response.raw = _RawResponse(resp)
+        return response
+
+    def close(self) -> None:
+        with self._lock:
+            for client in self._clients.values():
+                client.close()
+            self._clients.clear()
@@ -0,0 +1,558 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Output backends. The spider only deals with names relative to the dump
+root such as ``albums/<album>/<photo>`` or ``articles/<title>.md``.
+"""
+import contextlib
+import os
+import shutil
+import struct
+import tarfile
+import tempfile
+import threading
+import time
+import zipfile
+import zlib
+from typing import IO, Dict, Iterator, List, Optional, Set, Tuple
+
+from blobstore import BlobStore, BlobWriter
+
+
+class OutputWriter:
+    """Interface shared by every output backend.
+
+    Files opened with :meth:`open` only become visible once the ``with``
+    block exits without error. Photos go through :meth:`blob_writer` and are
+    then published under one or more names with :meth:`link_blob`, so
+    identical content is stored once wherever the backend allows it.
+
+    ``durable`` tells whether a written file survives the process being
+    killed. Where it doesn't, the state database can't say what is already
+    in the output, only :meth:`exists` can.
+    """
+
+    durable = True
+
+    def exists(self, name: str) -> bool:
+        raise NotImplementedError
+
+    def size(self, name: str) -> int:
+        raise NotImplementedError
+
+    def open(self, name: str, mode: str = "wb") -> IO:
+        raise NotImplementedError
+
+    def blob_writer(self) -> BlobWriter:
+        raise NotImplementedError
+
+    def has_blob(self, digest: str) -> bool:
+        raise NotImplementedError
+
+    def prepend(self, name: str, text: str) -> None:
+        """Put ``text`` before the content of an existing text file."""
+        raise NotImplementedError
+
+    def import_blob(self, path: str) -> Tuple[str, int]:
+        """Store a finished download as a blob and remove the file, return
+        the digest and size.
+        """
+        with open(path, "rb") as f, self.blob_writer() as blob:
+            shutil.copyfileobj(f, blob)
+        os.remove(path)
+        return blob.digest, blob.size
+
+    def link_blob(self, digest: str, name: str) -> None:
+        raise NotImplementedError
+
+    def close(self) -> None:
+        pass
+
+
+class DirectoryWriter(OutputWriter):
+    """Writes into a directory tree.
+
+    The names of the files already in a directory are read with a single
+    scandir the first time it is looked at, and the listing is kept current
+    as files are written. Skip checks are then memory lookups rather than a
+    stat per item. Sizes are only looked up when asked for.
+    """
+
+    BLOB_DIR = ".blobs"
+
+    def __init__(self, root: str) -> None:
+        self.root = root
+        self.blobs = BlobStore(os.path.join(root, self.BLOB_DIR))
+        self._listings: Dict[str, Dict[str, Optional[int]]] = {}
+        self._dirs: Set[str] = set()
+        self._lock = threading.Lock()
+
+    def path(self, name: str) -> str:
+        return os.path.join(self.root, *name.split("/"))
+
+    def _listing(self, directory: str) -> Dict[str, Optional[int]]:
+        """Return the files in ``directory`` with their sizes, ``None`` where
+        the size hasn't been looked up yet.
+        """
+        with self._lock:
+            listing = self._listings.get(directory)
+            if listing is None:
+                listing = {}
+                with contextlib.suppress(FileNotFoundError), \
+                        os.scandir(self.path(directory)) as entries:
+                    for entry in entries:
+                        # is_file() comes with the entry on most systems,
+                        # stat() would be a syscall per file.
+                        if entry.is_file() and not entry.name.endswith(".part"):
+                            listing[entry.name] = None
+                    self._dirs.add(directory)
+                self._listings[directory] = listing
+            return listing
+
+    def _prepare(self, name: str) -> str:
+        directory = name.rpartition("/")[0]
+        if directory not in self._dirs:
+            os.makedirs(self.path(directory), exist_ok=True)
+            self._dirs.add(directory)
+        return self.path(name)
+
+    def _added(self, name: str) -> None:
+        directory, _, filename = name.rpartition("/")
+        self._listing(directory)[filename] = None
+
+    def exists(self, name: str) -> bool:
+        directory, _, filename = name.rpartition("/")
+        return filename in self._listing(directory)
+
+    def size(self, name: str) -> int:
+        directory, _, filename = name.rpartition("/")
+        listing = self._listing(directory)
+        size = listing[filename]
+        if size is None:
+            size = listing[filename] = os.path.getsize(self.path(name))
+        return size
+
+    @contextlib.contextmanager
+    def open(self, name: str, mode: str = "wb") -> Iterator[IO]:
+        path = self._prepare(name)
+        part_path = f"{path}.part"
+        kwargs = {} if "b" in mode else {"encoding": "utf-8"}
+        try:
+            with open(part_path, mode, **kwargs) as f:
+                yield f
+        except BaseException:
+            with contextlib.suppress(OSError):
+                os.remove(part_path)
+            raise
+        os.replace(part_path, path)
+        self._added(name)
+
+    def prepend(self, name: str, text: str) -> None:
+        path = self.path(name)
+        with self.open(name, "w") as f:
+            f.write(text)
+            with contextlib.suppress(FileNotFoundError), \
+                    open(path, encoding="utf-8") as old:
+                shutil.copyfileobj(old, f)
+
+    def blob_writer(self):
+        return self.blobs.writer()
+
+    def has_blob(self, digest: str) -> bool:
+        return self.blobs.has(digest)
+
+    def import_blob(self, path: str) -> Tuple[str, int]:
+        return self.blobs.adopt(path)
+
+    def link_blob(self, digest: str, name: str) -> None:
+        path = self._prepare(name)
+        self.blobs.link(digest, path)
+        self._added(name)
+
+
+class _TextSpool:
+    def __init__(self, f: IO) -> None:
+        self._f = f
+
+    def write(self, text: str) -> int:
+        self._f.write(text.encode("utf-8"))
+        return len(text)
+
+
+class ArchiveWriter(OutputWriter):
+    """Streams every file into a single archive as the dump runs.
+
+    Data is staged in a spooled temporary file (kept in memory up to
+    SPOOL_SIZE) because archive members are written one at a time, while
+    downloads finish in any order on many threads.
+
+    Archives are only complete once closed. After a hard kill, whatever
+    complete members are found at the start of the file are kept and the
+    rest is cut off when the archive is opened again.
+    """
+
+    SPOOL_SIZE = 8 * 1024 * 1024
+    durable = False
+
+    def __init__(self, path: str, tmp_dir: Optional[str] = None) -> None:
+        self.path = path
+        # Where spools spill over, the system default if None.
+        self.tmp_dir = tmp_dir
+        self._lock = threading.Lock()
+        self._names: Dict[str, int] = {}
+        self._blobs: Dict[str, str] = {}
+        self._pending: Dict[str, IO] = {}
+
+    def exists(self, name: str) -> bool:
+        with self._lock:
+            return name in self._names
+
+    def size(self, name: str) -> int:
+        with self._lock:
+            return self._names[name]
+
+    def _spool(self) -> IO:
+        return tempfile.SpooledTemporaryFile(max_size=self.SPOOL_SIZE, dir=self.tmp_dir)
+
+    @contextlib.contextmanager
+    def open(self, name: str, mode: str = "wb") -> Iterator[IO]:
+        with self._spool() as spool:
+            yield spool if "b" in mode else _TextSpool(spool)
+            size = spool.tell()
+            spool.seek(0)
+            with self._lock:
+                self._add(name, spool, size)
+                self._names[name] = size
+
+    @contextlib.contextmanager
+    def blob_writer(self) -> Iterator[BlobWriter]:
+        spool = self._spool()
+        try:
+            blob = BlobWriter(spool)
+            yield blob
+            blob.finish()
+        except BaseException:
+            spool.close()
+            raise
+        with self._lock:
+            if blob.digest in self._blobs or blob.digest in self._pending:
+                spool.close()
+            else:
+                self._pending[blob.digest] = spool
+
+    def has_blob(self, digest: str) -> bool:
+        with self._lock:
+            return digest in self._blobs or digest in self._pending
+
+    def link_blob(self, digest: str, name: str) -> None:
+        with self._lock:
+            if name in self._names:
+                return
+            spool = self._pending.pop(digest, None)
+            if spool is not None:
+                with spool:
+                    size = spool.tell()
+                    spool.seek(0)
+                    self._add(name, spool, size)
+                self._blobs[digest] = name
+            else:
+                first = self._blobs[digest]
+                size = self._names[first]
+                self._add_duplicate(name, first, size)
+            self._names[name] = size
+
+    def _add(self, name: str, fileobj: IO, size: int) -> None:
+        raise NotImplementedError
+
+    def _add_duplicate(self, name: str, first: str, size: int) -> None:
+        raise NotImplementedError
+
+    def close(self) -> None:
+        with self._lock:
+            for spool in self._pending.values():
+                spool.close()
+            self._pending.clear()
+
+
+_LOCAL_HEADER = struct.Struct("<4s5H3L2H")
+_ZIP64_EXTRA = 1
+_ZIP32_MAX = 0xFFFFFFFF
+
+
+def _zip_member_data(f: IO, offset: int, compress_size: int, method: int) -> Iterator[bytes]:
+    """Yield the uncompressed content of a member whose data is at ``offset``."""
+    f.seek(offset)
+    remaining = compress_size
+    inflate = zlib.decompressobj(-15) if method == zipfile.ZIP_DEFLATED else None
+    while remaining:
+        chunk = f.read(min(remaining, 1024 * 1024))
+        if not chunk:
+            raise EOFError
+        remaining -= len(chunk)
+        yield inflate.decompress(chunk) if inflate else chunk
+    if inflate:
+        yield inflate.flush()
+
+
+def _complete_zip_members(f: IO) -> List[Tuple[zipfile.ZipInfo, int]]:
+    """Read the local headers of a zip that has no central directory, return
+    the members up to the first incomplete one with the offsets of their data.
+    """
+    archive_size = os.fstat(f.fileno()).st_size
+    members = []
+    offset = 0
+    while True:
+        f.seek(offset)
+        header = f.read(_LOCAL_HEADER.size)
+        if len(header) < _LOCAL_HEADER.size or header[:4] != zipfile.stringFileHeader:
+            break
+        (_, _, flags, method, mtime, mdate, crc, compress_size, size,
+         name_length, extra_length) = _LOCAL_HEADER.unpack(header)
+        name = f.read(name_length).decode("utf-8" if flags & 0x800 else "cp437")
+        extra = f.read(extra_length)
+        while len(extra) >= 4:
+            kind, length = struct.unpack("<HH", extra[:4])
+            if kind == _ZIP64_EXTRA:
+                values = list(struct.unpack(f"<{length // 8}Q", extra[4:4 + length // 8 * 8]))
+                if size == _ZIP32_MAX and values:
+                    size = values.pop(0)
+                if compress_size == _ZIP32_MAX and values:
+                    compress_size = values.pop(0)
+            extra = extra[4 + length:]
+        data = offset + _LOCAL_HEADER.size + name_length + extra_length
+        end = data + compress_size
+        if method not in (zipfile.ZIP_STORED, zipfile.ZIP_DEFLATED) or end > archive_size:
+            break
+        if not size:
+            # Sizes and CRC are filled in once the data is written, an empty
+            # member may be one that never got that far.
+            f.seek(end)
+            if f.read(4) not in (zipfile.stringFileHeader, zipfile.stringCentralDir):
+                break
+        info = zipfile.ZipInfo(name, (
+            (mdate >> 9) + 1980, (mdate >> 5) & 0xF, mdate & 0x1F,
+            mtime >> 11, (mtime >> 5) & 0x3F, (mtime & 0x1F) * 2,
+        ))
+        info.compress_type = method
+        info.compress_size = compress_size
+        info.file_size = size
+        info.CRC = crc
+        checked_crc = checked_size = 0
+        try:
+            for chunk in _zip_member_data(f, data, compress_size, method):
+                checked_crc = zlib.crc32(chunk, checked_crc)
+                checked_size += len(chunk)
+        except (EOFError, zlib.error):
+            break
+        if (checked_crc, checked_size) != (crc, size):
+            break
+        members.append((info, data))
+        offset = end
+    return members
+
+
+def _salvage_zip(path: str) -> None:
+    """Rewrite a zip that was never closed with its complete members."""
+    tmp_path = f"{path}.tmp"
+    with open(path, "rb") as f, zipfile.ZipFile(tmp_path, "w") as salvaged:
+        for info, offset in _complete_zip_members(f):
+            # Opening the member for writing resets the sizes of ``info``.
+            data = _zip_member_data(f, offset, info.compress_size, info.compress_type)
+            with salvaged.open(info, "w", force_zip64=True) as dest:
+                for chunk in data:
+                    dest.write(chunk)
+    os.replace(tmp_path, path)
+
+
+class ZipWriter(ArchiveWriter):
+    """Writes a zip archive, appending to it if it already exists.
+
+    The central directory is only written on close. A zip without one is
+    rebuilt from its local headers when opened.
+    """
+
+    # Photos are already compressed, only text is worth deflating.
+    COMPRESSED_SUFFIXES = (".md", ".txt", ".json")
+
+    def __init__(self, path: str, tmp_dir: Optional[str] = None) -> None:
+        super().__init__(path, tmp_dir)
+        exists = os.path.isfile(path)
+        if exists:
+            try:
+                zipfile.ZipFile(path).close()
+            except zipfile.BadZipFile:
+                _salvage_zip(path)
+        self._zip = zipfile.ZipFile(path, "a" if exists else "w")
+        self._names.update((info.filename, info.file_size) for info in self._zip.infolist())
+
+    def _info(self, name: str) -> zipfile.ZipInfo:
+        info = zipfile.ZipInfo(name, time.localtime()[:6])
+        if name.endswith(self.COMPRESSED_SUFFIXES):
+            info.compress_type = zipfile.ZIP_DEFLATED
+        return info
+
+    def _add(self, name: str, fileobj: IO, size: int) -> None:
+        with self._zip.open(self._info(name), "w", force_zip64=True) as dest:
+            shutil.copyfileobj(fileobj, dest)
+
+    def _add_duplicate(self, name: str, first: str, size: int) -> None:
+        # Zip has no links, so the member is copied. It is read out in full
+        # first because zipfile can't read and write the archive at once.
+        with self._spool() as spool:
+            with self._zip.open(first) as src:
+                shutil.copyfileobj(src, spool)
+            spool.seek(0)
+            self._add(name, spool, size)
+
+    def close(self) -> None:
+        super().close()
+        with self._lock:
+            self._zip.close()
+
+
+def _complete_tar_length(path: str) -> int:
+    """Return the length of the complete members at the start of a tar."""
+    file_size = os.path.getsize(path)
+    length = 0
+    try:
+        with tarfile.open(path, "r") as tar:
+            for member in tar:
+                end = member.offset_data + -(-member.size // tarfile.BLOCKSIZE) * tarfile.BLOCKSIZE
+                if end > file_size:
+                    break
+                length = end
+    except tarfile.ReadError:
+        pass
+    return length
+
+
+def _complete_zstd_length(path: str) -> int:
+    """Return the length of the complete zstd frames at the start of a file."""
+    import zstandard
+
+    length = 0
+    decompressor = zstandard.ZstdDecompressor()
+    frame = decompressor.decompressobj()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            position = f.tell() - len(chunk)
+            while chunk:
+                try:
+                    frame.decompress(chunk)
+                except zstandard.ZstdError:
+                    return length
+                if not frame.eof:
+                    break
+                position += len(chunk) - len(frame.unused_data)
+                length = position
+                chunk = frame.unused_data
+                frame = decompressor.decompressobj()
+    return length
+
+
+class TarWriter(ArchiveWriter):
+    """Writes a tar archive, optionally zstd compressed.
+
+    A plain ``.tar`` is appended to in place. Compressed archives can only
+    grow by adding another zstd frame holding a new tar stream, so a resumed
+    ``.tar.zst`` has to be read with ``tar --ignore-zeros``. A frame is
+    ended every FRAME_SIZE bytes as well, a run that is killed loses the
+    members of its unfinished frame only.
+    """
+
+    FRAME_SIZE = 64 * 1024 * 1024
+
+    def __init__(
+        self, path: str, compression: Optional[str] = None, tmp_dir: Optional[str] = None
+    ) -> None:
+        super().__init__(path, tmp_dir)
+        self._raw = None
+        self._frame_size = 0
+        exists = os.path.isfile(path)
+        if compression is None:
+            if exists:
+                length = _complete_tar_length(path)
+                with open(path, "r+b") as f:
+                    f.truncate(length)
+                    # Append mode expects the end of archive marker.
+                    f.seek(length)
+                    f.write(tarfile.NUL * tarfile.BLOCKSIZE * 2)
+            self._tar = tarfile.open(path, "a" if exists else "w")
+            self._names.update((m.name, m.size) for m in self._tar.getmembers())
+        elif compression == "zst":
+            try:
+                import zstandard
+            except ImportError:
+                raise RuntimeError("Writing .tar.zst archives requires the zstandard package")
+            length = _complete_zstd_length(path) if exists else 0
+            if exists:
+                with open(path, "r+b") as f:
+                    f.truncate(length)
+            if length:
+                with open(path, "rb") as f, \
+                        zstandard.ZstdDecompressor().stream_reader(f, read_across_frames=True) as reader, \
+                        tarfile.open(fileobj=reader, mode="r|", ignore_zeros=True) as tar:
+                    self._names.update((m.name, m.size) for m in tar)
+            self._raw = open(path, "ab")
+            self._stream = zstandard.ZstdCompressor().stream_writer(self._raw, closefd=False)
+            self._tar = tarfile.open(fileobj=self._stream, mode="w|")
+        else:
+            raise ValueError(f"Unsupported compression: {compression}")
+
+    def _info(self, name: str) -> tarfile.TarInfo:
+        info = tarfile.TarInfo(name)
+        info.mtime = int(time.time())
+        info.mode = 0o644
+        return info
+
+    def _add(self, name: str, fileobj: IO, size: int) -> None:
+        info = self._info(name)
+        info.size = size
+        self._tar.addfile(info, fileobj)
+        if self._raw is not None:
+            self._frame_size += size
+            if self._frame_size >= self.FRAME_SIZE:
+                self._end_frame()
+
+    def _end_frame(self) -> None:
+        import zstandard
+
+        # Each frame holds a whole tar stream, like the frames of earlier runs.
+        self._tar.close()
+        self._stream.flush(zstandard.FLUSH_FRAME)
+        self._tar = tarfile.open(fileobj=self._stream, mode="w|")
+        self._frame_size = 0
+
+    def _add_duplicate(self, name: str, first: str, size: int) -> None:
+        info = self._info(name)
+        info.type = tarfile.LNKTYPE
+        info.linkname = first
+        self._tar.addfile(info)
+
+    def close(self) -> None:
+        super().close()
+        with self._lock:
+            self._tar.close()
+            if self._raw is not None:
+                self._stream.close()
+                self._raw.close()
+
+
+OUTPUT_FORMATS = ("dir", "zip", "tar", "tar.zst")
+
+
+def create_writer(
+    output_dir: str, output_format: str = "dir", name: str = "renren",
+    tmp_dir: Optional[str] = None,
+) -> OutputWriter:
+    """Return the writer of a format. Archives spool members in ``tmp_dir``."""
+    if output_format == "dir":
+        return DirectoryWriter(output_dir)
+    os.makedirs(output_dir, exist_ok=True)
+    path = os.path.join(output_dir, f"{name}.{output_format}")
+    if output_format == "zip":
+        return ZipWriter(path, tmp_dir)
+    if output_format == "tar":
+        return TarWriter(path, tmp_dir=tmp_dir)
+    if output_format == "tar.zst":
+        return TarWriter(path, "zst", tmp_dir)
+    raise ValueError(f"Unknown output format: {output_format}")